@@ -13,6 +13,7 @@ from src.ui.map_overlay import MapOverlayWidget
 from src.ui.hp_overlay import HpOverlayWidget
 from src.ui.settings import SettingsWindow
 from src.updater import Updater
+from src.detector import notify_display_changed
 from src.common import APP_FULLNAME, APP_VERSION, ICON_PATH
 from src.logger import info, warning, error
 
@@ -113,6 +114,18 @@ if __name__ == "__main__":
     menu.aboutToShow.connect(on_menu_show)
     menu.aboutToHide.connect(on_menu_hide)
 
+    # 屏幕布局变化时通知截图后端重新获取屏幕列表
+    def watch_screen(screen):
+        screen.geometryChanged.connect(lambda *_: notify_display_changed())
+    def on_screen_added(screen):
+        watch_screen(screen)
+        notify_display_changed()
+    for screen in app.screens():
+        watch_screen(screen)
+    app.screenAdded.connect(on_screen_added)
+    app.screenRemoved.connect(lambda *_: notify_display_changed())
+    app.primaryScreenChanged.connect(lambda *_: notify_display_changed())
+
     # 启动输入监听
     input_thread = QThread()
     input.moveToThread(input_thread)
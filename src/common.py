@@ -48,6 +48,11 @@ def get_appdata_path(filename: str) -> str:
     app_data_dir.mkdir(parents=True, exist_ok=True)
     return str(app_data_dir / filename)
 
+def get_cache_path(filename: str) -> str:
+    cache_dir = Path(get_appdata_path("cache"))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return str(cache_dir / filename)
+
 def get_desktop_path(filename: str = "") -> str:
     desktop = Path(user_desktop_dir())
     desktop.mkdir(exist_ok=True)
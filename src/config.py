@@ -16,6 +16,15 @@ class Config:
 
     update_interval: float
     detect_intervals: dict[str, float]
+    shared_frame_capture: bool
+    capture_thread_enabled: bool
+    capture_thread_fps: float
+    capture_thread_max_frame_age: float
+    skip_unchanged_frame_detect: bool
+
+    session_record_enabled: bool
+    session_record_segment_seconds: float
+    session_record_max_segments: int
 
     foward_day_seconds: int
     back_day_seconds: int
@@ -34,6 +43,10 @@ class Config:
     mask_upper_white: list[int]
     scale_range: list[float]
     dayx_score_threshold: float
+    dayx_scale_lock_window: int
+    dayx_scale_full_search_interval: int
+    dayx_detect_all_langs: bool
+    dayx_prefilter_enabled: bool
     dayx_detect_langs: dict[str, str]
 
     lower_hls_not_in_rain: list[int]
@@ -54,11 +67,18 @@ class Config:
     map_overlay_draw_size_ratio: float | None
     full_map_hough_circle_thres: list[int]
     full_map_error_threshold: float
+    full_map_match_method: str
+    full_map_ring_error_threshold: float
     earth_shifting_error_threshold: float
+    map_align_method: str
+    map_align_phase_min_response: float
+    night_circle_match_threshold: float
     map_pattern_match_interval: float
     subicon_template_match_threshold: float
     poi_match_sample_ratio_w_nightlord: float
     poi_match_sample_ratio_wo_nightlord: float
+    poi_match_workers: int
+    poi_probe_error_margin: int
     default_map_pattern_match_topk: int
     max_map_pattern_match_topk: int
     min_map_pattern_match_topk: int
@@ -88,4 +108,11 @@ class Config:
         if mtime != _config_mtime:
             _config = load_yaml(CONFIG_PATH)
             _config_mtime = mtime
-        return Config(**_config)
\ No newline at end of file
+        return Config(**_config)
+
+    @staticmethod
+    def get_mtime() -> float | None:
+        """
+        返回当前已加载配置文件的修改时间，配置重新加载后会变化
+        """
+        return _config_mtime
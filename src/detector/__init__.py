@@ -1,10 +1,24 @@
 from src.detector.rain_detector import RainDetector, RainDetectResult, RainDetectParam
 from src.detector.day_detector import DayDetector, DayDetectResult, DayDetectParam
-from src.detector.map_detector import MapDetector, MapDetectResult, MapDetectParam
+from src.detector.map_detector import MapDetector, MapDetectResult, MapDetectParam, MapRecognitionContext, MapFrame
 from src.detector.hp_detector import HpDetector, HpDetectResult, HpDetectParam
 from src.detector.art_detector import ArtDetector, ArtDetectResult, ArtDetectParam
+from src.detector.capture import (
+    CaptureBackend, 
+    CaptureFrame, 
+    CaptureWorker,
+    MssCaptureBackend, 
+    ReplayCaptureBackend, 
+    SyntheticCaptureBackend,
+    notify_display_changed,
+)
+from src.detector.recorder import SessionRecorder, RecordingCaptureBackend, TraceReplayCaptureBackend
+from src.detector.utils import grab_frame, resolve_regions, get_capture_regions
+from src.config import Config
+from src.logger import debug
 from dataclasses import dataclass
-from mss import mss
+from typing import Callable
+import time
 
 
 @dataclass
@@ -25,23 +39,133 @@ class DetectResult:
 
 
 class DetectorManager:
-    def __init__(self):
-        self.sct = None
+    def __init__(self, backend: CaptureBackend | None = None):
+        # 未指定截图后端时在第一次检测时创建mss后端（mss对象需要在使用它的线程中创建）
+        self.backend = backend
         self.rain_detector = RainDetector()
         self.day_detector = DayDetector()
         self.map_detector = MapDetector()
         self.hp_detector = HpDetector()
         self.art_detector = ArtDetector()
+        self.frame: CaptureFrame | None = None
+        self.recorder: SessionRecorder | None = None
+        self.capture_worker: CaptureWorker | None = None
+
+    def start_capture_thread(
+        self, 
+        detect_interval: float = 0.0, 
+        backend_factory: Callable[[], CaptureBackend] = MssCaptureBackend,
+    ):
+        """
+        启动截图线程，之后 capture 优先使用截图线程最新的一帧，截图间隔不小于检测间隔
+        """
+        if self.capture_worker is None:
+            self.capture_worker = CaptureWorker(backend_factory, Config.get().capture_thread_fps, detect_interval)
+
+    def set_capture_interval(self, detect_interval: float):
+        if self.capture_worker is not None:
+            self.capture_worker.set_interval(detect_interval)
+
+    def pause_capture_thread(self):
+        """
+        不需要截图时（不检测或没有检测区域）暂停截图线程，下次 capture 时恢复
+        """
+        if self.capture_worker is not None:
+            self.capture_worker.set_regions(None)
+
+    def stop_capture_thread(self):
+        if self.capture_worker is not None:
+            self.capture_worker.stop()
+            self.capture_worker = None
+
+    def start_recording(self, path: str):
+        """
+        开始录制截图和检测结果到 path 目录下以开始时间命名的子目录，录制结果可以用 TraceReplayCaptureBackend 回放
+        """
+        if self.recorder is not None:
+            return
+        if self.backend is None:
+            self.backend = MssCaptureBackend()
+        config = Config.get()
+        self.recorder = SessionRecorder(
+            path, 
+            self.backend.monitors, 
+            config.session_record_segment_seconds, 
+            config.session_record_max_segments,
+        )
+        self.backend = RecordingCaptureBackend(self.backend, self.recorder)
+
+    def close(self):
+        """
+        停止截图线程和录制，释放检测器占用的线程
+        """
+        self.stop_capture_thread()
+        self.stop_recording()
+        self.map_detector.close()
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.backend = self.backend.backend
+        self.recorder.close()
+        self.recorder = None
+
+    def capture(self, params: DetectParam) -> CaptureFrame | None:
+        """
+        截取包含所有待检测区域的一帧画面，在 release_frame 之前的检测都从这一帧中取图
+        """
+        if self.backend is None:
+            self.backend = MssCaptureBackend()
+        # 只在这里转换一次区域，截图时直接使用转换结果
+        resolved_regions = resolve_regions(self.backend, [
+            self.day_detector.get_capture_region(params.day_detect_param),
+            self.rain_detector.get_capture_region(params.rain_detect_param),
+            self.map_detector.get_capture_region(params.map_detect_param),
+            self.hp_detector.get_capture_region(params.hp_detect_param),
+            self.art_detector.get_capture_region(params.art_detect_param),
+        ])
+        regions = [region.absolute_region for region in resolved_regions]
+        self.frame = None
+        if not regions:
+            self.pause_capture_thread()
+            return None
+
+        if self.capture_worker is not None:
+            capture_regions = get_capture_regions(regions)
+            self.capture_worker.set_regions(capture_regions)
+            # 截图线程的最新一帧足够新且包含所有区域时直接使用，否则在当前线程截图
+            if latest := self.capture_worker.get_latest_frame():
+                timestamp, parts = latest
+                frame = CaptureFrame(self.backend, parts, timestamp)
+                # 截图间隔跟随检测间隔，允许的帧龄相应放宽
+                max_age = Config.get().capture_thread_max_frame_age + self.capture_worker.interval
+                if time.time() - timestamp <= max_age and all(frame.crop(r) is not None for r in regions):
+                    self.frame = frame
+                    if self.recorder is not None:
+                        for region, bgra in parts:
+                            self.recorder.add_frame(region, bgra)
+                else:
+                    debug(f"DetectorManager: latest frame of capture thread is not usable, grab directly")
+
+        if self.frame is None:
+            self.frame = grab_frame(self.backend, resolved_regions)
+        return self.frame
+
+    def release_frame(self):
+        self.frame = None
 
     def detect(self, params: DetectParam) -> DetectResult:
-        if self.sct is None:
-            self.sct = mss()
+        if self.backend is None:
+            self.backend = MssCaptureBackend()
+        sct = self.frame if self.frame is not None else self.backend
         result = DetectResult()
-        result.day_detect_result = self.day_detector.detect(self.sct, params.day_detect_param)
-        result.rain_detect_result = self.rain_detector.detect(self.sct, params.rain_detect_param)
-        result.map_detect_result = self.map_detector.detect(self.sct, params.map_detect_param)
-        result.hp_detect_result = self.hp_detector.detect(self.sct, params.hp_detect_param)
-        result.art_detect_result = self.art_detector.detect(self.sct, params.art_detect_param)
+        result.day_detect_result = self.day_detector.detect(sct, params.day_detect_param)
+        result.rain_detect_result = self.rain_detector.detect(sct, params.rain_detect_param)
+        result.map_detect_result = self.map_detector.detect(sct, params.map_detect_param)
+        result.hp_detect_result = self.hp_detector.detect(sct, params.hp_detect_param)
+        result.art_detect_result = self.art_detector.detect(sct, params.art_detect_param)
+        if self.recorder is not None:
+            self.recorder.add_results(result)
         return result
         
         
\ No newline at end of file
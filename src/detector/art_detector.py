@@ -4,12 +4,19 @@ from dataclasses import dataclass
 from PIL import Image
 import time
 from PyQt6.QtGui import QPixmap
-from mss.base import MSSBase
 
 from src.config import Config
 from src.common import get_data_path, get_appdata_path
 from src.logger import info, warning, error
-from src.detector.utils import grab_region, resize_by_height_keep_aspect_ratio, match_template
+from src.detector.capture import CaptureBackend
+from src.detector.utils import (
+    grab_region, 
+    process_image,
+    get_image_fingerprint,
+    LastResultCache,
+    resize_array_by_height, 
+    match_template,
+)
 
 @dataclass
 class ArtDetectParam:
@@ -26,23 +33,35 @@ class ArtDetector:
         config = Config.get()
         self.art_imgs: dict[str, np.ndarray] = {}
         for art_type in config.art_info.keys():
-            img = Image.open(get_data_path(f"icons/art/{art_type}.png")).convert("RGB")
-            img = resize_by_height_keep_aspect_ratio(img, config.art_detect_standard_size)
-            w, h = img.size
-            img = np.array(img)[h//4:h*3//4, w//4:w*3//4]
+            img = np.array(Image.open(get_data_path(f"icons/art/{art_type}.png")).convert("RGB"))
+            # 模板与截图使用相同的缩放方式
+            img = resize_array_by_height(img, config.art_detect_standard_size)
+            h, w = img.shape[:2]
+            img = img[h//4:h*3//4, w//4:w*3//4]
             self.art_imgs[art_type] = img
+        self.last_result = LastResultCache()
 
-    def detect(self, sct: MSSBase, params: ArtDetectParam | None) -> ArtDetectResult:
+    def get_capture_region(self, params: ArtDetectParam | None) -> tuple[int] | None:
+        if params is None:
+            return None
+        return params.art_region
+
+    def detect(self, sct: CaptureBackend, params: ArtDetectParam | None) -> ArtDetectResult:
         if params is None or params.art_region is None:
             return ArtDetectResult()
         config = Config.get()
         ret = ArtDetectResult()
 
+        # 截图未变化时复用上次结果
+        sc = grab_region(sct, params.art_region, as_array=True)
+        cache_key = (get_image_fingerprint(sc), params.art_region, params.hdr_processing_enabled)
+        if config.skip_unchanged_frame_detect and (last_ret := self.last_result.get(cache_key)) is not None:
+            return last_ret
+
         # 根据参数选择图像处理方式
         processing = 'hdr_to_sdr' if params.hdr_processing_enabled else 'none'
-        sc = grab_region(sct, params.art_region, processing=processing).convert("RGB")
-        sc = resize_by_height_keep_aspect_ratio(sc, config.art_detect_standard_size)
-        sc = np.array(sc)
+        sc = process_image(sc, processing, params.art_region)
+        sc = cv2.cvtColor(resize_array_by_height(sc, config.art_detect_standard_size), cv2.COLOR_BGRA2RGB)
 
         best_art_type, best_score = None, 1.0
         for art_type, art_img in self.art_imgs.items():
@@ -60,6 +79,7 @@ class ArtDetector:
         else:
             info(f"No art detected, best score: {best_score:.4f}")
 
+        self.last_result.set(cache_key, ret)
         return ret
     
 
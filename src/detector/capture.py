@@ -0,0 +1,339 @@
+import cv2
+import os
+import time
+import bisect
+import threading
+import numpy as np
+from typing import Callable
+from mss import mss
+from mss.exception import ScreenShotError
+
+from src.logger import info, warning
+
+
+def get_bgra_image(img: np.ndarray) -> np.ndarray:
+    """
+    将灰度/BGR/BGRA图像统一转换为BGRA
+    """
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+    if img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    return img
+
+def crop_with_padding(img: np.ndarray, region: tuple[int]) -> np.ndarray:
+    """
+    从整幅画面中截取区域，超出画面的部分填充为黑色，保证返回的尺寸与区域一致
+    """
+    x, y, w, h = (int(v) for v in region)
+    img_h, img_w = img.shape[:2]
+    if x >= 0 and y >= 0 and x + w <= img_w and y + h <= img_h:
+        return img[y:y+h, x:x+w]
+    ret = np.zeros((h, w) + img.shape[2:], dtype=img.dtype)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, img_w), min(y + h, img_h)
+    if x0 < x1 and y0 < y1:
+        ret[y0-y:y1-y, x0-x:x1-x] = img[y0:y1, x0:x1]
+    return ret
+
+def get_single_monitors(w: int, h: int) -> list[dict]:
+    """
+    单屏幕的屏幕列表，格式同mss，monitors[0]为所有屏幕的汇总
+    """
+    monitor = {"left": 0, "top": 0, "width": w, "height": h}
+    return [dict(monitor), dict(monitor)]
+
+
+class CaptureBackend:
+    """
+    截图后端接口，grab 接收绝对坐标区域 (x, y, w, h)，返回 (h, w, 4) 的BGRA numpy数组
+    """
+    monitors_generation: int = 0    # 每次重新获取屏幕列表后递增，RegionResolver据此清空缓存
+
+    @property
+    def monitors(self) -> list[dict]:
+        raise NotImplementedError
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+_display_change_count = 0   # 屏幕布局变化通知的次数
+
+
+def notify_display_changed():
+    """
+    屏幕布局变化时调用（例如Qt的屏幕增减和几何变化信号，可以在任意线程中调用），
+    各mss后端在下次获取屏幕列表时在自己的线程中重新创建mss实例
+    """
+    global _display_change_count
+    _display_change_count += 1
+
+
+class MssCaptureBackend(CaptureBackend):
+    """
+    使用mss截取屏幕，返回的数组直接引用截图缓冲区
+    """
+    def __init__(self):
+        self.sct = mss()
+        self.display_change_count = _display_change_count
+
+    def refresh(self):
+        """
+        重新创建mss实例，重新获取屏幕列表
+        """
+        self.sct.close()
+        self.sct = mss()
+        self.display_change_count = _display_change_count
+        self.monitors_generation += 1
+
+    @property
+    def monitors(self) -> list[dict]:
+        # mss会一直缓存屏幕列表，只在收到屏幕布局变化通知后重新创建实例
+        if self.display_change_count != _display_change_count:
+            info(f"MssCaptureBackend: Display changed, recreate mss")
+            self.refresh()
+        return self.sct.monitors
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        x, y, w, h = (int(v) for v in region)
+        monitor = {
+            "left": x,
+            "top": y,
+            "width": w,
+            "height": h,
+        }
+        try:
+            screenshot = self.sct.grab(monitor)
+        except ScreenShotError:
+            # 截图失败可能是屏幕布局发生了变化，重新创建实例后重试一次
+            warning(f"MssCaptureBackend: Grab {region} failed, recreate mss and retry")
+            self.refresh()
+            screenshot = self.sct.grab(monitor)
+        return np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(screenshot.height, screenshot.width, 4)
+
+    def close(self):
+        self.sct.close()
+
+
+REPLAY_IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+class ReplayCaptureBackend(CaptureBackend):
+    """
+    回放截图后端，按当前时间从图片目录或视频文件中取出对应的帧
+    图片目录中按文件名排序，文件名（不含扩展名）是数字时作为以秒为单位的时间戳，否则按 fps 依次排列
+    时间由 clock 提供，默认从创建时开始计时，传入固定的 clock 或调用 seek 可以得到确定的结果
+    """
+    def __init__(self, path: str, fps: float = 10.0, clock: Callable[[], float] | None = None):
+        self.path = path
+        self.clock = clock if clock is not None else time.perf_counter
+        self.start_time = self.clock()
+        self.video: cv2.VideoCapture | None = None
+        self.timestamps: list[float] = []
+        self.image_paths: list[str] = []
+        self.frame_count = 0
+        self.fps = fps
+        self.last_index: int | None = None
+        self.last_frame: np.ndarray | None = None
+
+        if os.path.isdir(path):
+            files = sorted(f for f in os.listdir(path) if f.lower().endswith(REPLAY_IMAGE_EXTS))
+            try:
+                frames = sorted((float(os.path.splitext(f)[0]), f) for f in files)
+            except ValueError:
+                frames = [(i / fps, f) for i, f in enumerate(files)]
+            self.timestamps = [t for t, _ in frames]
+            self.image_paths = [os.path.join(path, f) for _, f in frames]
+            self.frame_count = len(frames)
+        else:
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise ValueError(f"Failed to open replay video: {path}")
+            self.fps = self.video.get(cv2.CAP_PROP_FPS) or fps
+            self.frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.frame_count == 0:
+            raise ValueError(f"No frames found in replay source: {path}")
+
+        first_frame = self.get_frame_by_index(0)
+        self._monitors = get_single_monitors(first_frame.shape[1], first_frame.shape[0])
+        info(f"ReplayCaptureBackend: load {self.frame_count} frames from {path}")
+
+    @property
+    def monitors(self) -> list[dict]:
+        return self._monitors
+
+    def get_time(self) -> float:
+        return self.clock() - self.start_time
+
+    def seek(self, t: float):
+        """
+        跳转到回放的第 t 秒
+        """
+        self.start_time = self.clock() - t
+
+    def get_frame_index(self, t: float) -> int:
+        if self.video is not None:
+            index = int(t * self.fps)
+        else:
+            index = bisect.bisect_right(self.timestamps, t) - 1
+        return min(max(index, 0), self.frame_count - 1)
+
+    def get_frame_by_index(self, index: int) -> np.ndarray:
+        if index == self.last_index:
+            return self.last_frame
+        if self.video is not None:
+            # 顺序播放时直接读取下一帧，否则先定位
+            if self.last_index is None or index != self.last_index + 1:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ok, frame = self.video.read()
+            if not ok:
+                warning(f"ReplayCaptureBackend: failed to read frame {index} from {self.path}")
+                return self.last_frame
+        else:
+            frame = cv2.imdecode(np.fromfile(self.image_paths[index], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.last_index = index
+        self.last_frame = get_bgra_image(frame)
+        return self.last_frame
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        frame = self.get_frame_by_index(self.get_frame_index(self.get_time()))
+        return crop_with_padding(frame, region)
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+
+
+class SyntheticCaptureBackend(CaptureBackend):
+    """
+    合成截图后端，返回给定的画面，screen 为灰度/BGR/BGRA数组，
+    或者接收截图次数返回画面的函数，用于基准测试和回归测试
+    """
+    def __init__(self, screen: np.ndarray | Callable[[int], np.ndarray]):
+        self.grab_count = 0
+        self.set_screen(screen)
+
+    def set_screen(self, screen: np.ndarray | Callable[[int], np.ndarray]):
+        self.screen_func = screen if callable(screen) else None
+        self.screen = None if callable(screen) else get_bgra_image(screen)
+        size_screen = self.screen if self.screen is not None else get_bgra_image(screen(0))
+        self._monitors = get_single_monitors(size_screen.shape[1], size_screen.shape[0])
+
+    @property
+    def monitors(self) -> list[dict]:
+        return self._monitors
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        screen = self.screen
+        if self.screen_func is not None:
+            screen = get_bgra_image(self.screen_func(self.grab_count))
+        self.grab_count += 1
+        return crop_with_padding(screen, region)
+
+
+class CaptureFrame(CaptureBackend):
+    """
+    一次截图得到的画面，由若干块组成，相距较近的检测区域合并为一块截取，相距较远的分别截取。
+    各检测器从包含自己区域的块中取出（不复制的numpy视图），区域不在画面内时退回到原后端截图。
+    """
+    def __init__(
+        self, 
+        backend: CaptureBackend, 
+        parts: list[tuple[tuple[int], np.ndarray]], 
+        timestamp: float | None = None,
+    ):
+        self.backend = backend
+        self.parts = parts      # 每块的绝对坐标 (x, y, w, h) 和 (h, w, 4) BGRA
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    @property
+    def monitors(self) -> list[dict]:
+        return self.backend.monitors
+
+    @property
+    def monitors_generation(self) -> int:
+        return self.backend.monitors_generation
+
+    def crop(self, absolute_region: tuple[int]) -> np.ndarray | None:
+        """
+        取出绝对坐标区域对应的BGRA视图，区域不完全在任何一块内时返回None
+        """
+        x, y, w, h = (int(v) for v in absolute_region)
+        for (fx, fy, fw, fh), bgra in self.parts:
+            if fx <= x and fy <= y and x + w <= fx + fw and y + h <= fy + fh:
+                return bgra[y - fy:y - fy + h, x - fx:x - fx + w]
+        return None
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        bgra = self.crop(region)
+        if bgra is None:
+            bgra = self.backend.grab(region)
+        return bgra
+
+
+class CaptureWorker:
+    """
+    截图线程，使用在线程内创建的截图后端（mss对象不能跨线程使用）按目标帧率截取指定的各个区域，
+    截图结果写入双缓冲，检测线程通过 get_latest_frame 取最新的一帧，不会被截图阻塞
+    截图间隔不小于检测间隔（set_interval），区域为None时暂停截图
+    """
+    def __init__(self, backend_factory: Callable[[], CaptureBackend], fps: float, min_interval: float = 0.0):
+        self.backend_factory = backend_factory
+        self.fps = fps
+        self.interval = max(1.0 / fps, min_interval)
+        self.regions: list[tuple[int]] | None = None
+        # 双缓冲，每项为 (时间戳, [(区域, BGRA画面)])
+        self.frames: list[tuple[float, list[tuple[tuple[int], np.ndarray]]] | None] = [None, None]
+        self.front = 0
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        info(f"CaptureWorker: started with fps {fps}")
+
+    def set_regions(self, regions: list[tuple[int]] | None):
+        """
+        设置截图的绝对坐标区域列表，从下一次截图开始生效，设置为None时暂停截图并丢弃已有的帧
+        """
+        self.regions = regions
+        if regions is None:
+            with self.lock:
+                self.frames = [None, None]
+
+    def set_interval(self, min_interval: float):
+        """
+        设置截图间隔的下限（检测间隔），截图频率不超过目标帧率
+        """
+        self.interval = max(1.0 / self.fps, min_interval)
+
+    def get_latest_frame(self) -> tuple[float, list[tuple[tuple[int], np.ndarray]]] | None:
+        with self.lock:
+            return self.frames[self.front]
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        info("CaptureWorker: stopped")
+
+    def _run(self):
+        backend = self.backend_factory()
+        try:
+            while self.running:
+                t = time.perf_counter()
+                regions = self.regions
+                if regions is not None:
+                    try:
+                        parts = [(region, backend.grab(region)) for region in regions]
+                    except Exception as e:
+                        warning(f"CaptureWorker: grab regions {regions} failed: {e}")
+                    else:
+                        back = 1 - self.front
+                        self.frames[back] = (time.time(), parts)
+                        with self.lock:
+                            self.front = back
+                time.sleep(max(self.interval - (time.perf_counter() - t), 0.0))
+        finally:
+            backend.close()
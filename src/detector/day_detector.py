@@ -1,43 +1,142 @@
 import cv2
+import os
 import numpy as np
 from dataclasses import dataclass
 from PIL import Image
 import time
-from mss.base import MSSBase
 import yaml
 
 from src.config import Config
 from src.logger import info, warning, error, debug
-from src.common import get_data_path
-from src.detector.utils import resize_by_height_keep_aspect_ratio, grab_region
+from src.common import get_data_path, get_appdata_path, load_yaml, save_yaml
+from src.detector.capture import CaptureBackend
+from src.detector.utils import (
+    resize_array_by_height,
+    grab_region,
+    process_image,
+    get_image_fingerprint,
+    LastResultCache,
+)
 
 
-def get_image_mask(image: Image.Image) -> np.ndarray:
+def get_image_mask(image: Image.Image | np.ndarray) -> np.ndarray:
+    """
+    获取白色文字的掩码，numpy数组视为BGR(A)
+    """
     config = Config.get()
-    image_np = np.array(image)
-    image_bgr = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-    hsv = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2HSV)
+    if isinstance(image, Image.Image):
+        image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     lower_white = np.array(config.mask_lower_white)
     upper_white = np.array(config.mask_upper_white)
     mask = cv2.inRange(hsv, lower_white, upper_white)
     # cv2.imwrite(f"sandbox/debug_hsv_mask.png", mask)
     return mask
 
-def match_mask(image: np.ndarray, template: np.ndarray) -> float:
+def get_template_pyramid(template: np.ndarray, scales: np.ndarray) -> list[np.ndarray]:
+    """
+    预先计算模板在各个缩放比例下的图像
+    """
+    h, w = template.shape
+    return [cv2.resize(template, (int(w * scale), int(h * scale))) for scale in scales]
+
+@dataclass
+class MaskSignature:
+    """
+    模板掩码的白色像素数和列投影，像素值按0~1计算，用于在模板匹配前排除不可能匹配的区域
+    """
+    height: int
+    sum: float              # 像素值之和
+    square_sum: float       # 像素值平方和
+    columns: np.ndarray     # 每列像素值之和，(1, w) float32
+
+def get_mask_signature(template: np.ndarray) -> MaskSignature:
+    t = template.astype(np.float32) / 255
+    columns = t.sum(axis=0, dtype=np.float32)[None]
+    return MaskSignature(
+        height=template.shape[0],
+        sum=float(columns.sum()),
+        square_sum=float((t * t).sum()),
+        columns=columns,
+    )
+
+DAYX_PREFILTER_MARGIN = 1e-3    # 下界与阈值比较时的余量，抵消浮点误差
+
+class MaskLowerBound:
+    """
+    计算模板在二值掩码上匹配差异(TM_SQDIFF_NORMED)的下界，下界不小于阈值时模板不可能匹配成功。
+    设模板为T，窗口为I（0/1），a=sum(T), a2=sum(T^2), b=sum(I)，差异为 sum((T-I)^2) / sqrt(a2*b)，其中：
+      sum((T-I)^2) >= a2 + b - 2*min(a, b)              （T和I重合的部分不超过min(a, b)）
+      sum((T-I)^2) >= sum_j((t_j - c_j)^2) / h          （t_j、c_j为每列之和，柯西不等式）
+    依次用整个区域的白色像素数、各窗口的白色像素数、各窗口的列投影计算，越往后越准确但越慢
+    """
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.image_sum = cv2.countNonZero(image)
+        self.integral: np.ndarray | None = None     # 白色像素数的积分图 (h+1, w+1)
+
+    def get(self, signature: MaskSignature, threshold: float) -> float:
+        a, a2, h = signature.sum, signature.square_sum, signature.height
+        threshold += DAYX_PREFILTER_MARGIN
+        if self.image_sum == 0:
+            return float('inf')
+        # 窗口白色像素数不超过整个区域，b <= a 时下界随b递减
+        if self.image_sum <= a:
+            bound = (a2 - self.image_sum) / np.sqrt(a2 * self.image_sum)
+            if bound >= threshold:
+                return bound
+
+        if self.integral is None:
+            self.integral = cv2.integral(self.image, sdepth=cv2.CV_32F)
+            np.divide(self.integral, 255, out=self.integral)
+        w = signature.columns.shape[1]
+        # 各个纵向位置的每列白色像素数的横向累加 (ny, W+1)
+        rows = self.integral[h:] - self.integral[:-h]
+        # 各个窗口的白色像素数 (ny, nx)，没有白色像素的窗口不可能匹配，用一个很小的值代替避免除以0
+        b = np.maximum(rows[:, w:] - rows[:, :-w], DAYX_PREFILTER_MARGIN)
+        denominator = np.sqrt(b * a2)
+        diff = a2 + b - 2 * np.minimum(b, a)
+        bound = float((diff / denominator).min())
+        if bound >= threshold:
+            return bound
+
+        # 各个纵向位置的窗口每列白色像素数 (ny, W)，与模板列投影的差的平方和 (ny, nx)
+        window_columns = np.diff(rows, axis=1)
+        sq = cv2.matchTemplate(window_columns, signature.columns, cv2.TM_SQDIFF)
+        return float((np.maximum(sq * (1 / h), diff) / denominator).min())
+
+def match_mask(
+    image: np.ndarray, 
+    template_pyramid: list[np.ndarray], 
+    scale_indices: range,
+    signatures: list[MaskSignature] | None = None,
+    threshold: float = 0.0,
+) -> tuple[float, int | None]:
+    """
+    在给定的缩放比例中匹配模板，返回最小的差异和对应的缩放序号
+    给出模板签名时先计算差异的下界，下界不小于阈值时不再进行模板匹配
+    """
     t = time.time()
-    scale_range = np.linspace(*Config.get().scale_range, endpoint=True)
-    score = float('inf')
-    for scale in scale_range:
-        w, h = template.shape[::-1]
-        resized_template = cv2.resize(template, (int(w * scale), int(h * scale)))
+    score, best_index = float('inf'), None
+    lower_bound = MaskLowerBound(image) if signatures is not None else None
+    for index in scale_indices:
+        resized_template = template_pyramid[index]
         if resized_template.shape[0] > image.shape[0] or resized_template.shape[1] > image.shape[1]:
             continue
+        if lower_bound is not None:
+            if lower_bound.get(signatures[index], threshold) >= threshold + DAYX_PREFILTER_MARGIN:
+                # 未匹配时TM_SQDIFF_NORMED的结果不超过1
+                score = min(score, 1.0)
+                continue
+            # 有一个比例不能排除时，其他比例大概率也不能排除，直接匹配避免额外的开销
+            lower_bound = None
         res = cv2.matchTemplate(image, resized_template, cv2.TM_SQDIFF_NORMED)
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-        score = min(score, min_val)
+        if min_val < score:
+            score, best_index = min_val, index
     # print("match mask score: ", score)
     # print("match mask time: ", time.time() - t)
-    return score
+    return score, best_index
 
 
 @dataclass
@@ -54,6 +153,7 @@ class DayDetectResult:
     score_day1: float = None
     score_day2: float = None
     score_day3: float = None
+    lang: str | None = None     # 匹配成功时的语言
 
 
 @dataclass
@@ -64,75 +164,193 @@ class DayTempalte:
     day3_mask: np.ndarray
     day2_w_ratio: float
     day3_w_ratio: float
+    day1_pyramid: list[np.ndarray]
+    day2_pyramid: list[np.ndarray]
+    day3_pyramid: list[np.ndarray]
+    day1_signatures: list[MaskSignature]
+    day2_signatures: list[MaskSignature]
+    day3_signatures: list[MaskSignature]
+
+
+DAYX_SCALE_LOCK_SAVE_PATH = get_appdata_path("dayx_scale_lock.yaml")
 
 
 class DayDetector:
     def __init__(self):
         config = Config.get()
+        self.scales = np.linspace(*config.scale_range, endpoint=True)
         self.templates: dict[str, DayTempalte] = {}
         for lang in config.dayx_detect_langs.keys():
-            day1_image = Image.open(get_data_path(f"day_template/{lang}_1.png")).convert("RGB")
-            day2_image = Image.open(get_data_path(f"day_template/{lang}_2.png")).convert("RGB")
-            day3_image = Image.open(get_data_path(f"day_template/{lang}_3.png")).convert("RGB")
-            day1_mask = get_image_mask(resize_by_height_keep_aspect_ratio(day1_image, config.template_standard_height))
-            day2_mask = get_image_mask(resize_by_height_keep_aspect_ratio(day2_image, config.template_standard_height))
-            day3_mask = get_image_mask(resize_by_height_keep_aspect_ratio(day3_image, config.template_standard_height))
+            # 模板与截图使用相同的缩放方式，避免插值差异影响匹配分数
+            day1_image = cv2.cvtColor(np.array(Image.open(get_data_path(f"day_template/{lang}_1.png")).convert("RGB")), cv2.COLOR_RGB2BGR)
+            day2_image = cv2.cvtColor(np.array(Image.open(get_data_path(f"day_template/{lang}_2.png")).convert("RGB")), cv2.COLOR_RGB2BGR)
+            day3_image = cv2.cvtColor(np.array(Image.open(get_data_path(f"day_template/{lang}_3.png")).convert("RGB")), cv2.COLOR_RGB2BGR)
+            day1_mask = get_image_mask(resize_array_by_height(day1_image, config.template_standard_height))
+            day2_mask = get_image_mask(resize_array_by_height(day2_image, config.template_standard_height))
+            day3_mask = get_image_mask(resize_array_by_height(day3_image, config.template_standard_height))
             # cv2.imwrite(f"sandbox/debug_day1_{lang}.png", day1_mask)
             # cv2.imwrite(f"sandbox/debug_day2_{lang}.png", day2_mask)
             # cv2.imwrite(f"sandbox/debug_day3_{lang}.png", day3_mask)
+            day1_pyramid = get_template_pyramid(day1_mask, self.scales)
+            day2_pyramid = get_template_pyramid(day2_mask, self.scales)
+            day3_pyramid = get_template_pyramid(day3_mask, self.scales)
             template = DayTempalte(
                 lang=lang,
                 day1_mask=day1_mask, day2_mask=day2_mask, day3_mask=day3_mask,
                 day2_w_ratio=day2_mask.shape[1] / day1_mask.shape[1],
                 day3_w_ratio=day3_mask.shape[1] / day1_mask.shape[1],
+                day1_pyramid=day1_pyramid,
+                day2_pyramid=day2_pyramid,
+                day3_pyramid=day3_pyramid,
+                day1_signatures=[get_mask_signature(m) for m in day1_pyramid],
+                day2_signatures=[get_mask_signature(m) for m in day2_pyramid],
+                day3_signatures=[get_mask_signature(m) for m in day3_pyramid],
             )
             self.templates[lang] = template
+        self.last_scores = LastResultCache()
 
-    def match(self, sct: MSSBase, template: DayTempalte, params: DayDetectParam) -> tuple[bool, float]:
+        # 匹配成功的缩放比例，按语言、屏幕分辨率和区域保存
+        self.scale_locks: dict[str, float] = {}
+        if os.path.exists(DAYX_SCALE_LOCK_SAVE_PATH):
+            self.scale_locks = load_yaml(DAYX_SCALE_LOCK_SAVE_PATH)
+        self.match_count = 0
+
+    def get_scale_lock_key(self, sct: CaptureBackend, day1_region: tuple[int]) -> str:
+        # 各语言模板缩放到相同的高度，缩放比例只与分辨率和区域有关
+        screen = sct.monitors[0]
+        return f"{screen['width']}x{screen['height']}_{'_'.join(str(int(v)) for v in day1_region)}"
+
+    def get_scale_indices(self, lock_key: str) -> range:
+        """
+        获取本次匹配要搜索的缩放序号，已锁定缩放比例时只搜索附近的比例，每隔一定次数完整搜索一次
+        """
+        config = Config.get()
+        self.match_count += 1
+        scale = self.scale_locks.get(lock_key)
+        if scale is None or self.match_count % config.dayx_scale_full_search_interval == 0:
+            return range(len(self.scales))
+        index = int(np.argmin(np.abs(self.scales - scale)))
+        window = config.dayx_scale_lock_window
+        return range(max(index - window, 0), min(index + window + 1, len(self.scales)))
+
+    def update_scale_lock(self, lock_key: str, index: int):
+        scale = round(float(self.scales[index]), 4)
+        if self.scale_locks.get(lock_key) != scale:
+            self.scale_locks[lock_key] = scale
+            save_yaml(DAYX_SCALE_LOCK_SAVE_PATH, self.scale_locks)
+            info(f"DayDetector: lock scale {scale} for {lock_key}")
+
+    def get_day_regions(self, template: DayTempalte, day1_region: tuple[int]) -> tuple[tuple[int], tuple[int]]:
+        """
+        根据DAY1区域获取DAY2和DAY3的区域，DAY3区域最宽，包含另外两个区域
+        """
+        x, y, w, h = day1_region
+        cx, cy = x + w // 2, y + h // 2
+        day2_w = int(w * template.day2_w_ratio)
+        day2_region = (cx - day2_w // 2, cy - h // 2, day2_w, h)
+        day3_w = int(w * template.day3_w_ratio)
+        day3_region = (cx - day3_w // 2, cy - h // 2, day3_w, h)
+        return day2_region, day3_region
+
+    def get_match_templates(self, params: DayDetectParam) -> list[DayTempalte]:
+        if Config.get().dayx_detect_all_langs or params.lang is None:
+            return list(self.templates.values())
+        return [self.templates[params.lang]]
+
+    def get_match_region(self, templates: list[DayTempalte], day1_region: tuple[int]) -> tuple[int]:
+        """
+        获取包含所有模板DAY1/2/3区域的最宽区域
+        """
+        regions = [day1_region]
+        for template in templates:
+            regions.extend(self.get_day_regions(template, day1_region))
+        return max(regions, key=lambda r: r[2])
+
+    def get_capture_region(self, params: DayDetectParam | None) -> tuple[int] | None:
+        if params is None or params.day1_region is None:
+            return None
+        return self.get_match_region(self.get_match_templates(params), params.day1_region)
+
+    def match(
+        self, 
+        sct: CaptureBackend, 
+        templates: list[DayTempalte], 
+        params: DayDetectParam,
+    ) -> dict[str, tuple[float, float, float]]:
+        """
+        匹配所有模板，返回每种语言DAY1/2/3的差异
+        """
         try:
             config = Config.get()
             t = time.time()
             day1_region = params.day1_region
-            x, y, w, h = day1_region
-            cx, cy = x + w // 2, y + h // 2
-            day2_w = int(w * template.day2_w_ratio)
-            day2_region = (cx - day2_w // 2, cy - h // 2, day2_w, h)
-            day3_w = int(w * template.day3_w_ratio)
-            day3_region = (cx - day3_w // 2, cy - h // 2, day3_w, h)
+            region = self.get_match_region(templates, day1_region)
+            langs = tuple(template.lang for template in templates)
+            # 截图未变化时复用上次结果
+            sc = grab_region(sct, region, as_array=True)
+            cache_key = (get_image_fingerprint(sc), region, langs, params.hdr_processing_enabled)
+            if config.skip_unchanged_frame_detect and (last_scores := self.last_scores.get(cache_key)) is not None:
+                return last_scores
             # 根据参数选择图像处理方式
             processing = 'hdr_to_sdr' if params.hdr_processing_enabled else 'none'
-            sc = grab_region(sct, day3_region, processing=processing)
-            def match_region(region: tuple[int], template_mask: np.ndarray) -> float:
-                region = (
-                    region[0] - day3_region[0], 
-                    region[1] - day3_region[1], 
-                    region[0] - day3_region[0] + region[2], 
-                    region[1] - day3_region[1] + region[3]
+            sc = process_image(sc, processing, region)
+            # 对最宽的区域只计算一次缩放和掩码，各模板从中截取自己的区域
+            mask = get_image_mask(resize_array_by_height(sc, config.template_standard_height))
+            ratio = mask.shape[1] / region[2]
+            lock_key = self.get_scale_lock_key(sct, day1_region)
+            scale_indices = self.get_scale_indices(lock_key)
+            def match_region(
+                day_region: tuple[int], 
+                template_pyramid: list[np.ndarray], 
+                signatures: list[MaskSignature],
+            ) -> tuple[float, int | None]:
+                x0 = round((day_region[0] - region[0]) * ratio)
+                x1 = round((day_region[0] + day_region[2] - region[0]) * ratio)
+                # 预筛选：先用白色像素数和列投影排除不可能匹配的模板
+                signatures = signatures if config.dayx_prefilter_enabled else None
+                return match_mask(mask[:, x0:x1], template_pyramid, scale_indices, signatures, config.dayx_score_threshold)
+
+            scores: dict[str, tuple[float, float, float]] = {}
+            best_score, best_index = float('inf'), None
+            for template in templates:
+                day2_region, day3_region = self.get_day_regions(template, day1_region)
+                results = (
+                    match_region(day1_region, template.day1_pyramid, template.day1_signatures),
+                    match_region(day2_region, template.day2_pyramid, template.day2_signatures),
+                    match_region(day3_region, template.day3_pyramid, template.day3_signatures),
                 )
-                img = sc.crop(region)
-                img = resize_by_height_keep_aspect_ratio(img, config.template_standard_height)
-                img_mask = get_image_mask(img)
-                return match_mask(img_mask, template_mask)
-            score_day1 = match_region(day1_region, template.day1_mask)
-            score_day2 = match_region(day2_region, template.day2_mask)
-            score_day3 = match_region(day3_region, template.day3_mask)
-            debug(f"detect dayx time: {time.time() - t} lang: {template.lang} score: {score_day1:.2f}, {score_day2:.2f}, {score_day3:.2f}")
-            return score_day1, score_day2, score_day3
+                scores[template.lang] = tuple(score for score, _ in results)
+                for score, index in results:
+                    if score < best_score:
+                        best_score, best_index = score, index
+            # 匹配成功时锁定缩放比例
+            if best_score < config.dayx_score_threshold and best_index is not None:
+                self.update_scale_lock(lock_key, best_index)
+            debug(f"detect dayx time: {time.time() - t} scores: " + ", ".join(
+                f"{lang}: {s1:.2f} {s2:.2f} {s3:.2f}" for lang, (s1, s2, s3) in scores.items()))
+            self.last_scores.set(cache_key, scores)
+            return scores
         except Exception as e:
             error(f"Detect dayx error")
-            return float('inf'), float('inf'), float('inf')
+            return { template.lang: (float('inf'), float('inf'), float('inf')) for template in templates }
 
-    def detect(self, sct: MSSBase, params: DayDetectParam | None) -> DayDetectResult:
+    def detect(self, sct: CaptureBackend, params: DayDetectParam | None) -> DayDetectResult:
         ret = DayDetectResult()
         config = Config.get()
         if params is None or params.day1_region is None:
             return ret
-        template = self.templates[params.lang]
-        score_day1, score_day2, score_day3 = self.match(sct, template, params)
+        scores = self.match(sct, self.get_match_templates(params), params)
+        # 取差异最小的语言
+        lang = min(scores, key=lambda lang: min(scores[lang]))
+        score_day1, score_day2, score_day3 = scores[lang]
         ret.score_day1 = score_day1
         ret.score_day2 = score_day2
         ret.score_day3 = score_day3
-        if score_day1 < config.dayx_score_threshold: ret.start_day1 = True
-        if score_day2 < config.dayx_score_threshold: ret.start_day2 = True
-        if score_day3 < config.dayx_score_threshold: ret.start_day3 = True
+        # 只取差异最小的一天（"DAY II"中也包含"DAY I"，避免同时匹配）
+        best_day = int(np.argmin(scores[lang])) + 1
+        if scores[lang][best_day - 1] < config.dayx_score_threshold:
+            ret.start_day1 = best_day == 1
+            ret.start_day2 = best_day == 2
+            ret.start_day3 = best_day == 3
+            ret.lang = lang
         return ret
\ No newline at end of file
@@ -4,11 +4,11 @@ from dataclasses import dataclass
 from PIL import Image
 import time
 from PyQt6.QtGui import QPixmap
-from mss.base import MSSBase
 
 from src.config import Config
 from src.logger import info, warning, error, debug
-from src.detector.utils import grab_region, resize_by_height_keep_aspect_ratio
+from src.detector.capture import CaptureBackend
+from src.detector.utils import grab_region, resize_array_by_height
 
 
 @dataclass
@@ -27,19 +27,24 @@ class HpDetector:
         self.last_valid_length: int | None = None
         self.stable_count: int = 0
 
-    def detect(self, sct: MSSBase, params: HpDetectParam | None) -> HpDetectResult:
+    def get_capture_region(self, params: HpDetectParam | None) -> tuple[int] | None:
+        if params is None or params.hpbar_region is None:
+            return None
+        x, y, w, h = params.hpbar_region
+        w = int(h * Config.get().hpbar_region_aspect_ratio)
+        return (x, y, w, h)
+
+    def detect(self, sct: CaptureBackend, params: HpDetectParam | None) -> HpDetectResult:
         if params is None or params.hpbar_region is None:
             return HpDetectResult()
         config = Config.get()
         ret = HpDetectResult()
 
         t = time.time()
-        x, y, w, h = params.hpbar_region
-        w = h * config.hpbar_region_aspect_ratio
-        img = grab_region(sct, (x, y, w, h), processing='none')
-        original_w = img.width
-        img = resize_by_height_keep_aspect_ratio(img, config.hpbar_detect_std_height)
-        hsv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2HSV)
+        img = grab_region(sct, self.get_capture_region(params), processing='none', as_array=True)
+        original_w = img.shape[1]
+        img = resize_array_by_height(img, config.hpbar_detect_std_height)
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
 
         # 截取中线的亮度
         mid_y = hsv.shape[0] // 2
@@ -71,7 +76,7 @@ class HpDetector:
             cur_is_peak = peak_score >= interval // 2
             
             if cur_is_peak:
-                length = int(i * original_w / img.width)
+                length = int(i * original_w / img.shape[1])
                 # cv2.circle(debug_img, (i, 100 - vals[i] * 100 // 255), 2, (0, 0, 255), -1)
             if cur_is_peak and not last_is_peak:
                 peak_num += 1
@@ -134,8 +139,8 @@ class HpDetector:
             if self.last_valid_length is not None and self.stable_count > 5:
                 ret.hpbar_length = self.last_valid_length
 
-        # debug_img = cv2.resize(debug_img, (img.width, debug_img.shape[0]))
-        # debug_img = cv2.vconcat([np.array(img), debug_img])
+        # debug_img = cv2.resize(debug_img, (img.shape[1], debug_img.shape[0]))
+        # debug_img = cv2.vconcat([cv2.cvtColor(img, cv2.COLOR_BGRA2BGR), debug_img])
         # cv2.imwrite("sandbox/debug_hpbar_v_channel.png", debug_img)
         
         debug(f"HpDetector: lengths={self.recent_lengths}, time={time.time() - t:.3f}s")
@@ -4,28 +4,36 @@ import numpy as np
 from dataclasses import dataclass, field
 from PIL import Image
 import time
-from mss.base import MSSBase
 from enum import Enum
-import random
 import gc
+import glob
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from src.config import Config
 from src.logger import info, warning, error, debug
-from src.common import get_appdata_path, get_data_path
+from src.common import get_appdata_path, get_data_path, get_cache_path
 from src.detector.map_info import (
     load_map_info, 
     STD_MAP_SIZE, 
     Position,
     MapPattern,
-    Construct,
+    PatternScoreMatrix,
+    get_base_icon_code,
+    get_subicon_code,
 )
+from src.detector.capture import CaptureBackend
 from src.detector.utils import (
     paste_cv2,
     draw_icon,
     draw_text,
     grab_region,
     match_template,
-    align_image,
+    process_image,
+    get_image_fingerprint,
+    LastResultCache,
+    ImageAligner,
+    PhaseCorrelationAligner,
 )
 
 
@@ -53,6 +61,16 @@ def open_cv2_image(path: str, size: tuple[int, int] | None = None) -> np.ndarray
 
 
 CHECK_FULL_MAP_STD_SIZE = (100, 100)
+CHECK_FULL_MAP_REGION = (0.0, 0.78, 0.22, 1.0)  # 判断全图时使用的左下角区域 (x0, y0, x1, y1)，相对地图尺寸的比例
+# 圆环边缘能量判断全图的参数，均为相对判断区域尺寸的比例
+CHECK_FULL_MAP_RING_CENTER = (0.485, 0.505) # 罗盘外圈圆心
+CHECK_FULL_MAP_RING_RADIUS = 0.425          # 罗盘外圈半径，与hough方式的期望半径一致
+CHECK_FULL_MAP_RING_WIDTH = 0.02            # 圆环半宽
+CHECK_FULL_MAP_RING_BAND_GAP = 0.04         # 圆环内外对照带与圆周的距离
+CHECK_FULL_MAP_RING_BAND_WIDTH = 0.04
+CHECK_FULL_MAP_RING_MAX_OFFSET = 0.03       # 圆心搜索范围
+CHECK_FULL_MAP_RING_SECTOR_NUM = 12         # 圆环按角度划分的扇区数
+CHECK_FULL_MAP_RING_SECTOR_QUANTILE = 0.5   # 取各扇区误差的该分位数，只有一段直边经过圆环时不会判断为全图
 
 MATCH_EARTH_SHIFTING_SIZE = (100, 100)
 MATCH_EARTH_SHIFTING_REGION = (
@@ -63,6 +81,10 @@ MATCH_EARTH_SHIFTING_REGION = (
 )
 MATCH_EARTH_SHIFTING_OFFSET_AND_STRIDE = (5, 1)
 MATCH_EARTH_SHIFTING_SCALES = (0.95, 1.05, 7)
+MATCH_EARTH_SHIFTING_HIST_BINS = (16, 8)    # 初筛使用的色相、饱和度直方图bin数
+MATCH_EARTH_SHIFTING_HIST_TOPK = 2          # 直方图初筛后进入像素匹配的地图数量
+MATCH_EARTH_SHIFTING_COARSE_STRIDE = 2      # 粗搜索的偏移步长，之后在最佳的几个位置附近按原步长细搜索
+MATCH_EARTH_SHIFTING_COARSE_TOPK = 4        # 粗搜索后进入细搜索的位置数量
 
 MAP_BGS = { i : open_cv2_image(f"maps/{i}.jpg") for i in range(6) }
 MAG_BG_FOR_POI_MATCH_INDEX_MAP = {
@@ -70,6 +92,26 @@ MAG_BG_FOR_POI_MATCH_INDEX_MAP = {
     0: 0, 1: 0, 2: 0, 3: 0, 4: 4, 5: 0,
 }
 
+CONTEXT_REVERIFY_POI_NUM = 4   # 复用上次POI识别结果前重新校验的POI数量
+CONTEXT_RECHECK_NIGHTLORD_MARGIN = 0.05   # 复用夜王前只匹配该夜王图标，差异比识别时大超过该值时重新识别
+MIN_POI_PROBE_NUM = 8           # 地图模式匹配最少匹配的POI点数量
+
+MAP_ALIGN_REGION = (    # 地图对齐时用于特征匹配的区域 (x, y, w, h)
+    int(STD_MAP_SIZE[0] * 0.2),
+    int(STD_MAP_SIZE[1] * 0.2),
+    int(STD_MAP_SIZE[0] * 0.6),
+    int(STD_MAP_SIZE[1] * 0.6),
+)
+MAP_ALIGN_FEATURES_VERSION = 1  # 特征提取逻辑变化时递增，使磁盘缓存失效
+
+# 缩圈位置匹配参数
+NIGHT_CIRCLE_ICON_SIZE = (112, 112)     # 标准地图尺寸下缩圈图标大小
+NIGHT_CIRCLE_MATCH_CROP = 0.5           # 只使用图标中心的白色圆盘部分进行匹配
+NIGHT_CIRCLE_MATCH_SCALES = (0.8, 1.0, 1.2)
+NIGHT_CIRCLE_MATCH_MAX_OFFSET = 6
+NIGHT_CIRCLE_MATCH_MARGIN = 0.1         # 最佳位置需领先其他位置的分数，否则不进行筛选
+NIGHT_CIRCLE_MISMATCH_ERROR = 20        # 缩圈位置不符合的地图模式增加的误差，相当于两个POI完全不符合
+
 MATCH_NIGHTLORD_SIZE = (300, 300)
 NIGHTLORD_ICONS = { i : open_pil_image(f"icons/nightlord/{i}.png") for i in range(10) }
 EVERNIGHT_NIGHTLORD_ICONS = { i : open_pil_image(f"icons/nightlord/e{i}.png") for i in range(9) }
@@ -91,6 +133,19 @@ POI_ICON_OFFSET = {
 POI_ICONS = { ctype: open_pil_image(f"icons/construct/{ctype}.png") for ctype in POI_ICON_SCALE.keys() }
 STD_POI_SIZE = (45, 45)
 
+# POI类别匹配参数
+POI_MATCH_DOWNSAMPLE_SIZE = (16, 16)
+POI_MATCH_MAX_OFFSET = 4
+POI_MATCH_OFFSET_STRIDE = 2
+POI_MATCH_SCALE_RANGE = (0.9, 1.1, 5)
+POI_MATCH_CROP = (  # 降采样后参与比较的区域 (h_min, h_max, w_min, w_max)
+    int(POI_MATCH_DOWNSAMPLE_SIZE[1] * 0.2),
+    int(POI_MATCH_DOWNSAMPLE_SIZE[1] * 0.8),
+    int(POI_MATCH_DOWNSAMPLE_SIZE[0] * 0.2),
+    int(POI_MATCH_DOWNSAMPLE_SIZE[0] * 0.6),
+)
+POI_TEMPLATE_BANK_VERSION = 1   # 模板生成逻辑变化时递增，使磁盘缓存失效
+
 class Attribute(Enum):
     FIRE = 0
     MAGIC = 1
@@ -162,6 +217,9 @@ CTYPE_SUBICON_MAP: dict[int, Attribute | Condition] = {
     52400: Attribute.HOLY,  # 圣下教堂
     52420: Condition.FROST,  # 冻伤下教堂
 }
+# 子图标编码，用于向量化比较
+SUBICON_CODES = { subicon: i for i, subicon in enumerate(SUBICON_IMAGES) }
+CTYPE_SUBICON_CODE_MAP = { ctype: SUBICON_CODES[subicon] for ctype, subicon in CTYPE_SUBICON_MAP.items() }
 
 
 def get_poi_key(ctype: int) -> int | None:
@@ -194,14 +252,27 @@ def match_prefix(ctype: int, prefix: list[int] | int) -> bool:
             x //= 10
     return False
 
-def has_same_base_icon(ctype1: int, ctype2: int) -> bool:
+def get_poi_match_score_error(
+    matrix: PatternScoreMatrix, 
+    cols: np.ndarray, 
+    ctypes: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
     """
-    判断两个建筑类型是否使用相同的基础图标
+    计算各位置识别出的POI类型与各地图模式预期类型的匹配分数和误差，返回(P, len(cols))的矩阵
     """
-    if ctype1 // 10000 == 5 or ctype2 // 10000 == 5:
-        return ctype1 // 100 == ctype2 // 100   # DLC建筑必须前三位完全相同才共用图标
-    else:
-        return ctype1 // 1000 == ctype2 // 1000
+    subicon = get_subicon_code(ctypes, CTYPE_SUBICON_CODE_MAP)
+    expect_subicon = matrix.subicon_codes[:, cols]
+    same_base_icon = matrix.base_icon_codes[:, cols] == get_base_icon_code(ctypes)
+    same_subicon = expect_subicon == subicon
+    any_subicon = (expect_subicon >= 0) | (subicon >= 0)
+    conds = [
+        same_base_icon & same_subicon,      # 完全符合
+        same_base_icon & ~any_subicon,      # 子图标不符合
+        ~same_base_icon & same_subicon,     # 建筑类型不符合但子图标符合
+    ]   # 其余情况为建筑类型和子图标都不符合，或一个有子图标一个没有
+    score = np.select(conds, [10, 3, 1], 0).astype(np.int32)
+    error = np.select(conds, [0, 1, 3], 10).astype(np.int32)
+    return score, error
 
 
 @dataclass
@@ -221,6 +292,85 @@ class PoiCategoryInfo:
         return self.resized_images[size]
 
 
+@dataclass
+class PoiTemplateBank:
+    """
+    POI候选模板库，模板只取决于地图背景、位置和POI类别，与截图无关，因此只需构建一次
+    """
+    map_bg_index: int
+    templates: dict[tuple[Position, int], np.ndarray] = field(default_factory=dict)  # [pos, poi_key] -> (N, H, W, 3) float32
+
+    def get(self, pos: Position, poi_key: int) -> np.ndarray | None:
+        return self.templates.get((pos, poi_key))
+
+    def save(self, path: str, index_path: str):
+        """
+        所有模板拼接为一个.npy文件，另存 (x, y, poi_key, start, count) 索引
+        """
+        keys = sorted(self.templates.keys())
+        index, start = [], 0
+        for pos, poi_key in keys:
+            count = len(self.templates[(pos, poi_key)])
+            index.append((pos[0], pos[1], poi_key, start, count))
+            start += count
+        data = np.concatenate([self.templates[key] for key in keys])
+        # 保存到临时文件然后替换，索引最后写入，防止写入过程中程序崩溃导致缓存损坏
+        for target, array in ((path, data), (index_path, np.array(index, dtype=np.int32))):
+            tmp_path = target + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, target)
+
+    @staticmethod
+    def load(map_bg_index: int, path: str, index_path: str) -> 'PoiTemplateBank':
+        """
+        以内存映射方式加载模板，与系统文件缓存共享页面
+        """
+        index = np.load(index_path)
+        data = np.load(path, mmap_mode='r')
+        if data.dtype != np.float32 or (len(index) and int(index[-1, 3] + index[-1, 4]) != len(data)):
+            raise ValueError(f"Invalid poi template bank file: {path}")
+        bank = PoiTemplateBank(map_bg_index=map_bg_index)
+        for x, y, poi_key, start, count in index.tolist():
+            bank.templates[((x, y), poi_key)] = data[start:start+count]
+        return bank
+
+
+def get_map_align_features_hash(map_bg_index: int) -> str:
+    """
+    根据背景图和对齐参数计算对齐基准特征的内容哈希
+    """
+    hasher = hashlib.sha1()
+    with open(get_data_path(f"maps_poi_match/{map_bg_index}.jpg"), "rb") as f:
+        hasher.update(f.read())
+    hasher.update(repr((
+        MAP_ALIGN_FEATURES_VERSION, 
+        STD_MAP_SIZE, MAP_ALIGN_REGION, 
+        cv2.__version__,    # 不同版本的SIFT结果可能不同
+    )).encode())
+    return hasher.hexdigest()[:16]
+
+def get_poi_template_bank_hash(map_bg_index: int) -> str:
+    """
+    根据图标、背景、地图数据和匹配参数计算POI模板库的内容哈希
+    """
+    hasher = hashlib.sha1()
+    paths = [get_data_path(f"maps_poi_match/{map_bg_index}.jpg")]
+    paths += [get_data_path(f"icons/construct/{ctype}.png") for ctype in sorted(POI_ICONS.keys())]
+    paths += [get_data_path(f"csv/{name}.csv") for name in ("map_patterns", "constructs", "positions")]
+    for path in paths:
+        with open(path, "rb") as f:
+            hasher.update(f.read())
+    hasher.update(repr((
+        POI_TEMPLATE_BANK_VERSION,
+        STD_MAP_SIZE, STD_POI_SIZE,
+        POI_ICON_SCALE, POI_ICON_OFFSET,
+        POI_MATCH_DOWNSAMPLE_SIZE, POI_MATCH_MAX_OFFSET, POI_MATCH_OFFSET_STRIDE,
+        POI_MATCH_SCALE_RANGE, POI_MATCH_CROP,
+    )).encode())
+    return hasher.hexdigest()[:16]
+
+
 @dataclass
 class MapPatternMatchResult:
     pattern: MapPattern
@@ -229,20 +379,123 @@ class MapPatternMatchResult:
     error: int
 
 
+def get_split_entropy(ctype_codes: np.ndarray, code_num: int) -> np.ndarray:
+    """
+    计算候选模式在各POI点上预期类型分布的熵，越大说明该点越能区分候选模式
+    ctype_codes 为 (P, N) 的预期类型序号，用bincount一次统计所有列的类型数量
+    """
+    p, n = ctype_codes.shape
+    if p == 0 or n == 0:
+        return np.zeros(n, dtype=np.float64)
+    indices = ctype_codes + np.arange(n, dtype=np.int64) * code_num
+    counts = np.bincount(indices.ravel(), minlength=n * code_num).reshape(n, code_num)
+    probs = counts / p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(np.where(counts > 0, probs * np.log2(probs), 0.0), axis=1)
+
+def is_best_determined(errors: np.ndarray, margin: float) -> bool:
+    """
+    判断误差最小的结果是否已与其余结果拉开安全误差余量。
+    界面默认显示第1名，其余结果只作为备选按当前误差排序，不为了确定它们的顺序继续匹配
+    """
+    if len(errors) <= 1:
+        return True
+    partitioned = np.partition(errors, 1)
+    return partitioned[1] - partitioned[0] >= margin
+
+
+def get_map_sub_region(map_region: tuple[int, int, int, int], region: tuple[float, float, float, float]) -> tuple[int, int, int, int]:
+    """
+    计算地图中按比例表示的区域 (x0, y0, x1, y1) 对应的截图区域 (x, y, w, h)，与MapFrame的裁剪方式一致
+    """
+    x, y, w, h = map_region
+    x0, y0 = int(w * region[0]), int(h * region[1])
+    x1, y1 = int(w * region[2]), int(h * region[3])
+    return (x + x0, y + y0, x1 - x0, y1 - y0)
+
+
+class MapFrame:
+    """
+    一次截取的地图图像，各识别阶段需要的缩放结果在首次使用时计算并缓存，
+    同一帧的多个识别阶段共享同一个MapFrame即可只缩放一次
+    """
+    def __init__(self, img: np.ndarray, region: tuple[float, float, float, float] | None = None):
+        """
+        region为img在整张地图中对应的区域 (x0, y0, x1, y1)，相对地图尺寸的比例，为None时表示整张地图
+        """
+        self.img = img
+        self.region = region
+        self._resized: dict[tuple, np.ndarray] = {}
+
+    @property
+    def is_partial(self) -> bool:
+        return self.region is not None
+
+    def resize(
+        self, 
+        size: tuple[int, int], 
+        interpolation: int = CV2_RESIZE_METHOD, 
+        region: tuple[float, float, float, float] | None = None,
+    ) -> np.ndarray:
+        """
+        获取缩放到size的图像，region为缩放前裁剪的区域 (x0, y0, x1, y1)，相对图像尺寸的比例。
+        返回的图像只读，需要修改时应先复制
+        """
+        if self.region is not None:
+            if region != self.region:
+                raise ValueError(f"MapFrame: region {region} is not available in partial frame of region {self.region}")
+            region = None   # 图像本身就是该区域
+        key = (size, interpolation, region)
+        if key not in self._resized:
+            img = self.img
+            if region is not None:
+                h, w = img.shape[:2]
+                img = img[int(h * region[1]):int(h * region[3]), int(w * region[0]):int(w * region[2])]
+            resized = cv2.resize(img, size, interpolation=interpolation)
+            resized.flags.writeable = False
+            self._resized[key] = resized
+        return self._resized[key]
+
+
+@dataclass
+class MapRecognitionContext:
+    """
+    一局游戏内的地图识别上下文，特殊地形和夜王在一局内不会变化，新的Day1开始时重置
+    """
+    earth_shifting: int | None = None
+    nightlord: int | None = None
+    nightlord_matched: bool = False     # 夜王可能为None(隐藏夜王)，需单独记录是否已识别
+    nightlord_score: float = float('inf')   # 识别夜王时的差异，复用前用于校验
+    night_circle_pos: dict[int, Position] = field(default_factory=dict)    # 天数 -> 已识别的缩圈位置
+    poi_results: dict[Position, int] = field(default_factory=dict)
+
+    def reset(self):
+        self.earth_shifting = None
+        self.nightlord = None
+        self.nightlord_matched = False
+        self.nightlord_score = float('inf')
+        self.night_circle_pos.clear()
+        self.poi_results.clear()
+
+
 @dataclass
 class MapDetectParam:
     map_region: tuple[int] | None = None
     img: np.ndarray | None = None
+    frame: MapFrame | None = None   # 优先于img使用，多个阶段传入同一帧以复用缩放结果
     earth_shifting: int | None = None
     do_match_full_map: bool = False
     do_match_earth_shifting: bool = False
     do_match_pattern: bool = False
     return_pattern_topk: int | None = None
     hdr_processing_enabled: bool = False
+    context: MapRecognitionContext | None = None
+    day: int | None = None  # 当前天数，用于按缩圈位置筛选地图模式
 
 @dataclass
 class MapDetectResult:
     img: np.ndarray | None = None
+    frame: MapFrame | None = None   # 只判断全图时为只包含角落区域的部分帧
     is_full_map: bool = None
     earth_shifting: int | None = None
     earth_shifting_score: float | None = None
@@ -258,6 +511,7 @@ class MapDetector:
             get_data_path('csv/constructs.csv'),
             get_data_path('csv/names.csv'),
             get_data_path('csv/positions.csv'),
+            CTYPE_SUBICON_CODE_MAP,
         )
 
         # 初始化POI信息
@@ -314,15 +568,119 @@ class MapDetector:
             target_img = target_img.crop((int(w*0.3), int(h*0.3), int(w*0.7), int(h*0.7)))
             nightlords[i] = (nightlord, np.array(target_img)[..., :3])
         self.nightlord_icons: list[tuple[None | int, np.ndarray]] = nightlords
-            
+
+        # POI候选模板库，按POI匹配背景索引缓存，优先从磁盘缓存加载
+        self.poi_template_banks: dict[int, PoiTemplateBank] = {}
+        for bg_index in set(MAG_BG_FOR_POI_MATCH_INDEX_MAP.values()):
+            if bank := self._load_poi_template_bank(bg_index):
+                self.poi_template_banks[bg_index] = bank
+
+        # 地图对齐器，首次使用时创建
+        self.aligners: dict[int, ImageAligner] = {}
+        self.phase_aligners: dict[int, PhaseCorrelationAligner] = {}
+
+        # POI匹配线程池，首次并行匹配时创建，线程数变化时重建
+        self.poi_executor: ThreadPoolExecutor | None = None
+        self.poi_executor_workers = 0
+
+        # 判断全图用的圆环权重
+        self.full_map_ring_weights, self.full_map_ring_indices, self.full_map_ring_sectors = self._build_full_map_ring_weights()
+        self.last_full_map_result = LastResultCache()
+
+        # 特殊地形匹配用的各缩放比例下的地图区域，形状为 (缩放数, H+2*offset, W+2*offset, 3)
+        self.earth_shifting_pyramids: dict[int, np.ndarray] = {
+            map_id: self._build_earth_shifting_pyramid(map_img) for map_id, map_img in MAP_BGS.items()
+        }
+        # 特殊地形初筛用的颜色直方图
+        self.earth_shifting_hists: dict[int, np.ndarray] = {
+            map_id: self._calc_earth_shifting_hist(MapFrame(map_img).resize(MATCH_EARTH_SHIFTING_SIZE, cv2.INTER_AREA)) 
+            for map_id, map_img in MAP_BGS.items()
+        }
+
+        # 缩圈图标中心部分的各缩放比例灰度模板
+        night_circle_icon = cv2.cvtColor(open_cv2_image("icons/night_circle.png", NIGHT_CIRCLE_ICON_SIZE), cv2.COLOR_RGB2GRAY)
+        h, w = night_circle_icon.shape
+        ch, cw = int(h * NIGHT_CIRCLE_MATCH_CROP), int(w * NIGHT_CIRCLE_MATCH_CROP)
+        night_circle_icon = night_circle_icon[(h - ch) // 2:(h + ch) // 2, (w - cw) // 2:(w + cw) // 2]
+        self.night_circle_templates: list[np.ndarray] = [
+            cv2.resize(night_circle_icon, (int(cw * scale), int(ch * scale)), interpolation=CV2_RESIZE_METHOD)
+            for scale in NIGHT_CIRCLE_MATCH_SCALES
+        ]
+
         
-    def _match_full_map(self, img: np.ndarray) -> float:
-        config = Config.get()
-        img = img[-int(img.shape[0]*0.22):, :int(img.shape[1]*0.22)]
-        img = cv2.resize(img, CHECK_FULL_MAP_STD_SIZE, interpolation=CV2_RESIZE_METHOD)
+    def _build_full_map_ring_weights(self) -> tuple[np.ndarray, np.ndarray, list[tuple[np.ndarray, ...]]]:
+        """
+        构建各候选圆心下圆环和对照带的权重，与 (gx*gx, gx*gy, gy*gy) 拼接的特征点乘
+        即得到圆环上的径向梯度能量均值和对照带上的梯度能量均值。
+        返回形状为 (2*候选圆心数, 有效特征数) 的权重(前一半为圆环，后一半为对照带)，有效特征的下标，
+        以及每个候选圆心下按扇区统计用的 (圆环像素下标, ux, uy, 圆环像素扇区, 对照带像素下标, 对照带像素扇区)
+        """
+        w, h = CHECK_FULL_MAP_STD_SIZE
+        size = min(w, h)
+        ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+        # 按判断区域的尺寸换算为像素值
+        radius = CHECK_FULL_MAP_RING_RADIUS * size
+        ring_width = CHECK_FULL_MAP_RING_WIDTH * size
+        band_gap = CHECK_FULL_MAP_RING_BAND_GAP * size
+        band_width = CHECK_FULL_MAP_RING_BAND_WIDTH * size
+        max_offset = max(1, round(CHECK_FULL_MAP_RING_MAX_OFFSET * size))
+        offsets = range(-max_offset, max_offset + 1)
+        ring_weights, band_weights, sectors = [], [], []
+        for dy in offsets:
+            for dx in offsets:
+                cx, cy = CHECK_FULL_MAP_RING_CENTER[0] * w + dx, CHECK_FULL_MAP_RING_CENTER[1] * h + dy
+                dist = np.sqrt((xs - cx) ** 2 + (ys - cy) ** 2).ravel() + 1e-6
+                ux, uy = (xs.ravel() - cx) / dist, (ys.ravel() - cy) / dist
+                delta = np.abs(dist - radius)
+                ring = (delta <= ring_width).astype(np.float32)
+                band = ((delta > band_gap) & (delta <= band_gap + band_width)).astype(np.float32)
+                # 径向梯度的平方 (gx*ux + gy*uy)^2 展开后对三个特征是线性的
+                ring_weights.append(np.concatenate([ring * ux * ux, ring * 2 * ux * uy, ring * uy * uy]) / ring.sum())
+                band_weights.append(np.concatenate([band, np.zeros_like(band), band]) / band.sum())
+                sector = (((np.arctan2(uy, ux) + np.pi) / (2 * np.pi) * CHECK_FULL_MAP_RING_SECTOR_NUM).astype(np.int32)
+                          % CHECK_FULL_MAP_RING_SECTOR_NUM)
+                ring_idx, band_idx = np.flatnonzero(ring), np.flatnonzero(band)
+                sectors.append((ring_idx, ux[ring_idx], uy[ring_idx], sector[ring_idx], band_idx, sector[band_idx]))
+        weights = np.array(ring_weights + band_weights, dtype=np.float32)
+        # 只保留有权重的特征，减少每次点乘的数据量
+        indices = np.flatnonzero((weights != 0).any(axis=0))
+        return np.ascontiguousarray(weights[:, indices]), indices, sectors
+
+    def _match_full_map(self, frame: MapFrame, config: Config) -> bool:
+        if config.full_map_match_method == 'hough':
+            error = self._match_full_map_hough(frame, config.full_map_hough_circle_thres)
+            return error <= config.full_map_error_threshold
+        error = self._match_full_map_ring(frame)
+        return error <= config.full_map_ring_error_threshold
+
+    def _match_full_map_ring(self, frame: MapFrame) -> float:
+        """
+        罗盘外圈的边缘能量集中在圆周上且沿径向，用圆周两侧对照带的能量与圆周上径向能量之比作为误差。
+        先用整个圆环的均值选出最可能的圆心，再在该圆心下按扇区计算误差并取分位数，
+        避免一段经过圆环的直边（只覆盖少数扇区）拉低整体误差
+        """
+        img = frame.resize(CHECK_FULL_MAP_STD_SIZE, region=CHECK_FULL_MAP_REGION)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3).ravel()
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3).ravel()
+        features = np.concatenate([gx * gx, gx * gy, gy * gy])
+        energy = self.full_map_ring_weights @ features[self.full_map_ring_indices]
+        ring_energy, band_energy = np.split(energy, 2)
+        center = int(np.argmin((band_energy + 1) / (ring_energy + 1)))
+
+        ring_idx, ux, uy, ring_sector, band_idx, band_sector = self.full_map_ring_sectors[center]
+        n = CHECK_FULL_MAP_RING_SECTOR_NUM
+        ring_energy = np.bincount(ring_sector, (gx[ring_idx] * ux + gy[ring_idx] * uy) ** 2, n) / np.bincount(ring_sector, minlength=n)
+        band_energy = np.bincount(band_sector, gx[band_idx] ** 2 + gy[band_idx] ** 2, n) / np.bincount(band_sector, minlength=n)
+        error = float(np.quantile((band_energy + 1) / (ring_energy + 1), CHECK_FULL_MAP_RING_SECTOR_QUANTILE))
+        debug(f"MapDetector: Full map ring match error: {error:.4f}")
+        return error
+
+    def _match_full_map_hough(self, frame: MapFrame, circle_thres: list[int]) -> float:
+        img = frame.resize(CHECK_FULL_MAP_STD_SIZE, region=CHECK_FULL_MAP_REGION)
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         circles = []
-        for thres in config.full_map_hough_circle_thres:
+        for thres in circle_thres:
             res = cv2.HoughCircles(
                 gray, 
                 cv2.HOUGH_GRADIENT, 
@@ -345,43 +703,137 @@ class MapDetector:
         debug(f"MapDetector: Full map match error: {error:.4f}")
         return error
     
-    def _match_earth_shifting(self, img: np.ndarray) -> tuple[int, float]:
+    def _build_earth_shifting_pyramid(self, map_img: np.ndarray) -> np.ndarray:
+        x, y, w, h = MATCH_EARTH_SHIFTING_REGION
+        offset, _ = MATCH_EARTH_SHIFTING_OFFSET_AND_STRIDE
+        min_scale, max_scale, scale_num = MATCH_EARTH_SHIFTING_SCALES
+        pyramid = []
+        for scale in np.linspace(min_scale, max_scale, scale_num, endpoint=True):
+            size = (int(MATCH_EARTH_SHIFTING_SIZE[0] * scale), int(MATCH_EARTH_SHIFTING_SIZE[1] * scale))
+            map_resized = cv2.resize(map_img, size, interpolation=CV2_RESIZE_METHOD)
+            pyramid.append(map_resized[y-offset:y+h+offset, x-offset:x+w+offset])
+        return np.ascontiguousarray(np.array(pyramid, dtype=np.uint8))
+
+    def _calc_earth_shifting_hist(self, img: np.ndarray) -> np.ndarray:
+        """
+        img为MATCH_EARTH_SHIFTING_SIZE大小的图像
+        """
+        x, y, w, h = MATCH_EARTH_SHIFTING_REGION
+        hsv = cv2.cvtColor(img[y:y+h, x:x+w], cv2.COLOR_RGB2HSV)
+        # 只统计色相和饱和度，不受整体亮度变化影响
+        hist = cv2.calcHist([hsv], [0, 1], None, list(MATCH_EARTH_SHIFTING_HIST_BINS), [0, 180, 0, 256])
+        return cv2.normalize(hist, hist, 1, 0, cv2.NORM_L1)
+
+    def _score_earth_shifting_windows(self, pyramid: np.ndarray, img: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """
+        批量计算 candidates (K, 3) 中每个 (缩放索引, y偏移索引, x偏移索引) 窗口的误差
+        """
+        h, w = img.shape[0], img.shape[1]
+        window_num = len(candidates)
+        windows = np.lib.stride_tricks.sliding_window_view(pyramid, (h, w), axis=(1, 2))
+        windows = windows[candidates[:, 0], candidates[:, 1], candidates[:, 2]].transpose(0, 2, 3, 1)
+        windows = np.ascontiguousarray(windows).reshape(window_num * h, w * 3)
+        tiled_img = np.tile(img.reshape(h, w * 3), (window_num, 1))
+        diff = cv2.absdiff(windows, tiled_img)
+        _, diff = cv2.threshold(diff, 100, 0, cv2.THRESH_TOZERO_INV)   # 差异过大的像素视为遮挡，不计入
+        diff = diff.astype(np.uint16).reshape(window_num, h * w, 3)
+        diff *= diff
+        dist = diff[..., 0] + diff[..., 1] + diff[..., 2]
+        # 以距离平方的中位数近似距离中位数（不对中间两个值取平均）
+        median_index = h * w // 2
+        medians = np.partition(dist, median_index, axis=-1)[:, median_index]
+        return np.sqrt(medians.astype(np.float32))
+
+    def _match_earth_shifting(self, frame: MapFrame, map_ids: list[int] | None = None) -> tuple[int, float]:
         t = time.time()
-        img = cv2.resize(img, MATCH_EARTH_SHIFTING_SIZE, interpolation=CV2_RESIZE_METHOD)
+        # 第一阶段：按颜色直方图距离排序，只保留最相近的几张地图（已指定候选地图时跳过）
+        if map_ids is None:
+            hist = self._calc_earth_shifting_hist(frame.resize(MATCH_EARTH_SHIFTING_SIZE, cv2.INTER_AREA))
+            hist_dists = {
+                map_id: cv2.compareHist(hist, map_hist, cv2.HISTCMP_BHATTACHARYYA)
+                for map_id, map_hist in self.earth_shifting_hists.items()
+            }
+            map_ids = sorted(hist_dists, key=hist_dists.get)[:MATCH_EARTH_SHIFTING_HIST_TOPK]
+
+        # 第二阶段：在候选地图上先粗后细搜索偏移和缩放
+        img = frame.resize(MATCH_EARTH_SHIFTING_SIZE)
         x, y, w, h = MATCH_EARTH_SHIFTING_REGION
-        img = img[y:y+h, x:x+w].astype(int)
-        best_map_id, best_score = None, float('inf')
+        img = np.ascontiguousarray(img[y:y+h, x:x+w])
         offset, stride = MATCH_EARTH_SHIFTING_OFFSET_AND_STRIDE
-        min_scale, max_scale, scale_num = MATCH_EARTH_SHIFTING_SCALES
-        for map_id, map_img in MAP_BGS.items():
-            score = float('inf')
-            for scale in np.linspace(min_scale, max_scale, scale_num, endpoint=True):
-                size = (int(MATCH_EARTH_SHIFTING_SIZE[0] * scale), int(MATCH_EARTH_SHIFTING_SIZE[1] * scale))
-                map_resized = cv2.resize(map_img, size, interpolation=CV2_RESIZE_METHOD).astype(int)
-                for dx in range(-offset, offset+1, stride):
-                    for dy in range(-offset, offset+1, stride):
-                        map_shifted = map_resized[y+dy:y+h+dy, x+dx:x+w+dx]
-                        diff = np.abs((img - map_shifted))
-                        diff[diff > 100] = 0
-                        diff = np.linalg.norm(diff, axis=2)
-                        cur_score = np.median(diff)
-                        score = min(score, cur_score)
+        scale_num = MATCH_EARTH_SHIFTING_SCALES[2]
+        coarse_offsets = range(0, 2 * offset + 1, MATCH_EARTH_SHIFTING_COARSE_STRIDE)
+        coarse_candidates = np.array([
+            (si, oy, ox) for si in range(scale_num) for oy in coarse_offsets for ox in coarse_offsets
+        ])
+
+        best_map_id, best_score = None, float('inf')
+        for map_id in map_ids:
+            pyramid = self.earth_shifting_pyramids[map_id]
+            scores = self._score_earth_shifting_windows(pyramid, img, coarse_candidates)
+            topk = min(MATCH_EARTH_SHIFTING_COARSE_TOPK, len(scores))
+            radius = MATCH_EARTH_SHIFTING_COARSE_STRIDE - 1
+            fine_candidates = set()
+            for si, oy, ox in coarse_candidates[np.argpartition(scores, topk - 1)[:topk]].tolist():
+                fine_candidates.update(
+                    (fsi, foy, fox)
+                    for fsi in range(max(0, si - 1), min(scale_num, si + 2))
+                    for foy in range(max(0, oy - radius), min(2 * offset + 1, oy + radius + 1), stride)
+                    for fox in range(max(0, ox - radius), min(2 * offset + 1, ox + radius + 1), stride)
+                )
+            fine_candidates = np.array(sorted(fine_candidates))
+            scores = self._score_earth_shifting_windows(pyramid, img, fine_candidates)
+            score = float(scores.min())
             # print(f"map {map_id} score: {score:.4f}")
             if score < best_score:
                 best_score = score
                 best_map_id = map_id
         info(f"MapDetector: Match earth shifting: best map {best_map_id} score {best_score:.4f}, time cost: {time.time() - t:.4f}s")
         return best_map_id, best_score
-    
-    def _match_nightlord(self, img: np.ndarray) -> tuple[int | None, float]:
+
+    def _match_night_circle(self, img: np.ndarray, positions: list[Position]) -> tuple[Position | None, float]:
+        """
+        在给定的候选位置中寻找缩圈图标所在位置，无法确定时返回None
+        """
         t = time.time()
-        img = cv2.resize(img, MATCH_NIGHTLORD_SIZE, interpolation=CV2_RESIZE_METHOD)
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        r = NIGHT_CIRCLE_MATCH_MAX_OFFSET
+        scores: dict[Position, float] = {}
+        for x, y in positions:
+            score = -1.0
+            for template in self.night_circle_templates:
+                h, w = template.shape
+                x0, y0 = x - w // 2 - r, y - h // 2 - r
+                if x0 < 0 or y0 < 0 or x0 + w + 2 * r > gray.shape[1] or y0 + h + 2 * r > gray.shape[0]:
+                    continue
+                res = cv2.matchTemplate(gray[y0:y0 + h + 2 * r, x0:x0 + w + 2 * r], template, cv2.TM_CCOEFF_NORMED)
+                score = max(score, float(res.max()))
+            scores[(x, y)] = score
+
+        best_pos, best_score, second_score = None, -1.0, -1.0
+        for pos, score in scores.items():
+            if score > best_score:
+                best_pos, best_score, second_score = pos, score, best_score
+            elif score > second_score:
+                second_score = score
+        info(f"MapDetector: Match night circle best={best_pos} score={best_score:.4f} second={second_score:.4f}, time cost: {time.time() - t:.4f}s")
+        if best_score < Config.get().night_circle_match_threshold or best_score - second_score < NIGHT_CIRCLE_MATCH_MARGIN:
+            return None, best_score
+        return best_pos, best_score
+
+    def _match_nightlord(self, frame: MapFrame, nightlords: list[int | None] | None = None) -> tuple[int | None, float]:
+        """
+        识别夜王，nightlords 不为None时只匹配其中的夜王图标
+        """
+        t = time.time()
+        img = frame.resize(MATCH_NIGHTLORD_SIZE)
         h, w = img.shape[0], img.shape[1]
         img = img[-int(h*0.15):-int(h*0.05), int(w*0.06):int(w*0.16)]
 
         best_nightlord, best_score = None, float('inf')
         
         for nightlord, icon in self.nightlord_icons:
+            if nightlords is not None and nightlord not in nightlords:
+                continue
             match_result, score = match_template(
                 img, 
                 icon, 
@@ -425,59 +877,154 @@ class MapDetector:
                 img.alpha_composite(subicon, subicon_pos)
         return img
 
-    def _match_poi(self, map_img: np.ndarray, map_bg: np.ndarray, pos: Position, earth_shifting: int, nightlord: int | None = None) -> tuple[int, float]:
-        img = map_img[
+    def _load_poi_match_bg(self, bg_index: int) -> np.ndarray:
+        map_bg = open_cv2_image(f"maps_poi_match/{bg_index}.jpg")
+        return cv2.resize(map_bg, STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
+
+    def _get_possible_poi_keys(self, earth_shifting: int, nightlords: list[int] | set[int], pos: Position) -> list[int]:
+        """
+        获取某位置可能出现的POI大类别
+        """
+        possible_ctypes = set()
+        for nl in nightlords:
+            possible_ctypes.update(self.info.possible_poi_types.get((earth_shifting, nl, pos), set()))
+        return [
+            poi_key for poi_key in self.poi_cate_info.keys()
+            if any(match_prefix(ctype, poi_key) for ctype in possible_ctypes)
+        ]
+
+    def _build_poi_templates(self, map_bg: np.ndarray, pos: Position, poi_key: int) -> np.ndarray:
+        """
+        生成某位置某POI类别在所有偏移和缩放下的候选图像，返回 (N, H, W, 3) float32
+        """
+        bg = map_bg[
             pos[1]-STD_POI_SIZE[1]//2:pos[1]-STD_POI_SIZE[1]//2+STD_POI_SIZE[1],
             pos[0]-STD_POI_SIZE[0]//2:pos[0]-STD_POI_SIZE[1]//2+STD_POI_SIZE[0],
         ]
-        bg = map_bg[
+        bg = Image.fromarray(bg).convert("RGBA")
+        info = self.poi_cate_info[poi_key]
+        h_min, h_max, w_min, w_max = POI_MATCH_CROP
+        target_imgs = []
+        for dx in range(-POI_MATCH_MAX_OFFSET, POI_MATCH_MAX_OFFSET+1, POI_MATCH_OFFSET_STRIDE):
+            for dy in range(-POI_MATCH_MAX_OFFSET, POI_MATCH_MAX_OFFSET+1, POI_MATCH_OFFSET_STRIDE):
+                for s in np.linspace(*POI_MATCH_SCALE_RANGE, endpoint=True):
+                    size = (int(STD_POI_SIZE[0] * s), int(STD_POI_SIZE[1] * s))
+                    resized_poi_icon = info.get_resized_image(size)
+                    poi_img = bg.copy()
+                    poi_img.alpha_composite(resized_poi_icon, (dx, dy))
+                    poi_img = np.array(poi_img)[..., :3]
+                    poi_img = cv2.resize(poi_img, POI_MATCH_DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
+                    target_imgs.append(poi_img[h_min:h_max, w_min:w_max])
+        return np.ascontiguousarray(np.array(target_imgs), dtype=np.float32)
+
+    def _get_poi_template_bank_paths(self, bg_index: int) -> tuple[str, str]:
+        bank_hash = get_poi_template_bank_hash(bg_index)
+        return (
+            get_cache_path(f"poi_templates_{bg_index}_{bank_hash}.npy"),
+            get_cache_path(f"poi_templates_{bg_index}_{bank_hash}_index.npy"),
+        )
+
+    def _load_poi_template_bank(self, bg_index: int) -> PoiTemplateBank | None:
+        try:
+            path, index_path = self._get_poi_template_bank_paths(bg_index)
+            if not os.path.exists(path) or not os.path.exists(index_path):
+                return None
+            bank = PoiTemplateBank.load(bg_index, path, index_path)
+            info(f"MapDetector: Load {len(bank.templates)} poi templates of map bg {bg_index} from {path}")
+            return bank
+        except Exception as e:
+            warning(f"MapDetector: Load poi template bank of map bg {bg_index} failed: {e}")
+            return None
+
+    def _build_poi_template_bank(self, bg_index: int) -> PoiTemplateBank:
+        """
+        构建使用该背景的所有特殊地形下所有POI位置的模板，并保存到磁盘缓存
+        """
+        t = time.time()
+        keys: set[tuple[Position, int]] = set()
+        for es in self.info.all_earth_shiftings:
+            if MAG_BG_FOR_POI_MATCH_INDEX_MAP.get(es) != bg_index:
+                continue
+            for nl in self.info.all_nightlords:
+                for pos in self.info.all_poi_pos.get((es, nl), set()):
+                    for poi_key in self._get_possible_poi_keys(es, [nl], pos):
+                        keys.add((pos, poi_key))
+
+        bank = PoiTemplateBank(map_bg_index=bg_index)
+        map_bg = self._load_poi_match_bg(bg_index)
+        for pos, poi_key in sorted(keys):
+            bank.templates[(pos, poi_key)] = self._build_poi_templates(map_bg, pos, poi_key)
+        info(f"MapDetector: Build {len(keys)} poi templates of map bg {bg_index}, time cost: {time.time() - t:.4f}s")
+
+        if bank.templates:
+            try:
+                path, index_path = self._get_poi_template_bank_paths(bg_index)
+                bank.save(path, index_path)
+                # 清理过期的缓存文件
+                for old_path in glob.glob(get_cache_path(f"poi_templates_{bg_index}_*.npy")):
+                    if old_path not in (path, index_path):
+                        os.remove(old_path)
+            except Exception as e:
+                warning(f"MapDetector: Save poi template bank of map bg {bg_index} failed: {e}")
+        return bank
+
+    def _get_poi_template_bank(self, earth_shifting: int) -> PoiTemplateBank:
+        bg_index = MAG_BG_FOR_POI_MATCH_INDEX_MAP[earth_shifting]
+        if bg_index not in self.poi_template_banks:
+            self.poi_template_banks[bg_index] = self._build_poi_template_bank(bg_index)
+        return self.poi_template_banks[bg_index]
+
+    def _get_aligner(self, bg_index: int) -> ImageAligner:
+        """
+        获取对齐到该POI匹配背景的对齐器，基准特征缓存到磁盘
+        """
+        if bg_index not in self.aligners:
+            t = time.time()
+            path = get_cache_path(f"align_features_{bg_index}_{get_map_align_features_hash(bg_index)}.npy")
+            self.aligners[bg_index] = ImageAligner(self._load_poi_match_bg(bg_index), MAP_ALIGN_REGION, path)
+            # 清理过期的缓存文件
+            for old_path in glob.glob(get_cache_path(f"align_features_{bg_index}_*.npy")):
+                if old_path != path:
+                    try:
+                        os.remove(old_path)
+                    except Exception as e:
+                        warning(f"MapDetector: Remove stale align features {old_path} failed: {e}")
+            info(f"MapDetector: Init aligner of map bg {bg_index}, time cost: {time.time() - t:.4f}s")
+        return self.aligners[bg_index]
+
+    def _align_map_image(self, img: np.ndarray, bg_index: int) -> np.ndarray:
+        """
+        将地图对齐到POI匹配背景，相位相关模式下峰值响应过低时回退到SIFT
+        """
+        config = Config.get()
+        if config.map_align_method == 'phase':
+            if bg_index not in self.phase_aligners:
+                self.phase_aligners[bg_index] = PhaseCorrelationAligner(self._load_poi_match_bg(bg_index), MAP_ALIGN_REGION)
+            aligned_img, response = self.phase_aligners[bg_index].align(img)
+            if response >= config.map_align_phase_min_response:
+                return aligned_img
+            info(f"MapDetector: Phase correlation response {response:.4f} too low, fallback to sift")
+        return self._get_aligner(bg_index).align(img)
+
+    def _match_poi(self, map_img: np.ndarray, poi_bank: PoiTemplateBank, pos: Position, earth_shifting: int, nightlord: int | None = None) -> tuple[int, float]:
+        img = map_img[
             pos[1]-STD_POI_SIZE[1]//2:pos[1]-STD_POI_SIZE[1]//2+STD_POI_SIZE[1],
             pos[0]-STD_POI_SIZE[0]//2:pos[0]-STD_POI_SIZE[1]//2+STD_POI_SIZE[0],
         ]
-        
 
         # 判断建筑类型
-        DOWNSAMPLE_SIZE = (16, 16)
-        MAX_OFFSET = 4
-        OFFSET_STRIDE = 2
-        SCALE_RANGE = (0.9, 1.1, 5)
-
-        img_for_poi = cv2.resize(img, DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
-        h, w, _ = img_for_poi.shape
-        h_min, h_max, w_min, w_max = int(h*0.2), int(h*0.8), int(w*0.2), int(w*0.6)
-        img_for_poi = img_for_poi[h_min:h_max, w_min:w_max]
-        bg = Image.fromarray(bg).convert("RGBA")
+        h_min, h_max, w_min, w_max = POI_MATCH_CROP
+        img_for_poi = cv2.resize(img, POI_MATCH_DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
+        img_for_poi = img_for_poi[h_min:h_max, w_min:w_max].astype(np.float32)
 
         best_poi_key = None
         best_poi_key_score = float('inf')
 
-        # 收集该位置可能出现的POI类型
+        # 仅匹配该位置可能出现的POI类型
         nightlords = [nightlord] if nightlord is not None else self.info.all_nightlords
-        possible_ctypes = set()
-        for nl in nightlords:
-            possible_ctypes.update(self.info.possible_poi_types.get((earth_shifting, nl, pos), set()))
-
-        # print("pos:", pos, "possible ctypes:", possible_ctypes)
-        for poi_key, info in self.poi_cate_info.items():
-            t = time.time()
-            if not any(match_prefix(ctype, poi_key) for ctype in possible_ctypes):
-                continue    # 仅匹配该位置可能出现的POI类型
-            
-            target_imgs = []
-            for dx in range(-MAX_OFFSET, MAX_OFFSET+1, OFFSET_STRIDE):
-                for dy in range(-MAX_OFFSET, MAX_OFFSET+1, OFFSET_STRIDE):
-                    for s in np.linspace(SCALE_RANGE[0], SCALE_RANGE[1], SCALE_RANGE[2], endpoint=True):
-                        size = (int(STD_POI_SIZE[0] * s), int(STD_POI_SIZE[1] * s))
-                        resized_poi_icon = info.get_resized_image(size)
-                        poi_img = bg.copy()
-                        poi_img.alpha_composite(resized_poi_icon, (dx, dy))
-                        poi_img = np.array(poi_img)[..., :3]
-                        poi_img = cv2.resize(poi_img, DOWNSAMPLE_SIZE, interpolation=CV2_RESIZE_METHOD)
-                        poi_img = poi_img[h_min:h_max, w_min:w_max]
-                        target_imgs.append(poi_img)
-
-            target_imgs = np.array(target_imgs).astype(np.float32)
-            diffs = np.mean((target_imgs - img_for_poi.astype(np.float32)) ** 2, axis=(1, 2, 3))
+        for poi_key in self._get_possible_poi_keys(earth_shifting, nightlords, pos):
+            target_imgs = poi_bank.get(pos, poi_key)
+            diffs = np.mean((target_imgs - img_for_poi) ** 2, axis=(1, 2, 3))
             min_idx = np.argmin(diffs)
             poi_key_score = diffs[min_idx]
             if poi_key_score < best_poi_key_score:
@@ -485,11 +1032,9 @@ class MapDetector:
                 best_poi_key = poi_key
 
             # best_img = target_imgs[min_idx].astype(np.uint8)
-            # vis = np.concatenate([img_for_poi, best_img], axis=1)
+            # vis = np.concatenate([img_for_poi.astype(np.uint8), best_img], axis=1)
             # display_cv2_image(vis, None)
-            # if pos == (270, 615):
-            #     cv2.imwrite(f"sandbox/debug/{poi_key}.jpg", cv2.cvtColor(vis, cv2.COLOR_RGB2BGR))
-            # print(f"{pos} poi category {poi_key} match score: {poi_key_score:.4f}, time cost: {time.time() - t:.4f}s")
+            # print(f"{pos} poi category {poi_key} match score: {poi_key_score:.4f}")
 
         # print(f"Best {pos} poi category:", best_poi_key, "score:", best_poi_key_score)
 
@@ -541,103 +1086,205 @@ class MapDetector:
         best_ctype = sorted(list(self.poi_cate_info[best_poi_key].subtypes.get(best_subicon).ctypes))[0]
         return best_ctype, best_poi_key_score * best_subicon_score
 
-    def _match_map_pattern(self, img: np.ndarray, earth_shifting: int, topk: int) -> list[MapPatternMatchResult]:
+    def _match_pois(
+        self, 
+        map_img: np.ndarray, 
+        poi_bank: PoiTemplateBank, 
+        positions: list[Position], 
+        earth_shifting: int, 
+        nightlord: int | None = None,
+    ) -> dict[Position, int]:
+        """
+        匹配多个POI位置，各位置相互独立，主要耗时在释放GIL的OpenCV/NumPy操作中，因此使用线程池并行
+        """
+        def match(pos: Position) -> int:
+            return self._match_poi(map_img, poi_bank, pos, earth_shifting, nightlord)[0]
+
+        workers = max(1, min(Config.get().poi_match_workers, os.cpu_count() or 1))
+        if workers == 1 or len(positions) == 1:
+            return { pos: match(pos) for pos in positions }
+        executor = self._get_poi_executor(workers)
+        # executor.map按输入顺序返回结果，保证结果与串行一致
+        return dict(zip(positions, executor.map(match, positions)))
+
+    def _get_poi_executor(self, workers: int) -> ThreadPoolExecutor:
+        """
+        复用POI匹配线程池，避免每批POI都创建和销毁线程
+        """
+        if self.poi_executor is None or self.poi_executor_workers != workers:
+            if self.poi_executor is not None:
+                self.poi_executor.shutdown(wait=False)
+            self.poi_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poi_match")
+            self.poi_executor_workers = workers
+        return self.poi_executor
+
+    def close(self):
+        """
+        关闭POI匹配线程池
+        """
+        if self.poi_executor is not None:
+            self.poi_executor.shutdown(wait=True)
+            self.poi_executor = None
+
+    def _match_map_pattern(
+        self, 
+        frame: MapFrame, 
+        earth_shifting: int, 
+        topk: int | None, 
+        context: MapRecognitionContext | None = None,
+        day: int | None = None,
+    ) -> list[MapPatternMatchResult]:
         assert earth_shifting is not None, "earth_shifing should be provided when matching map pattern"
 
         t = time.time()
-        img = cv2.resize(img, STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
-
-        # 识别夜王
-        nightlord, _ = self._match_nightlord(img)
+        img = frame.resize(STD_MAP_SIZE)
+
+        if context is not None and context.earth_shifting != earth_shifting:
+            context.reset()
+            context.earth_shifting = earth_shifting
+
+        # 识别夜王，同一局内只匹配已识别的夜王图标进行校验，差异明显变大时重新识别
+        # （例如没有检测到新的Day1导致上下文未重置）
+        nightlord = None
+        if context is not None and context.nightlord_matched:
+            _, score = self._match_nightlord(frame, [context.nightlord])
+            if score <= context.nightlord_score + CONTEXT_RECHECK_NIGHTLORD_MARGIN:
+                nightlord = context.nightlord
+                info(f"MapDetector: Reuse nightlord {nightlord} from context")
+            else:
+                warning(f"MapDetector: Nightlord {context.nightlord} in context mismatch (score {score:.4f}), rematch nightlord")
+                context.nightlord_matched = False
+        if context is None or not context.nightlord_matched:
+            nightlord, score = self._match_nightlord(frame)
+            if context is not None:
+                if context.nightlord_score != float('inf') and nightlord != context.nightlord:
+                    # 夜王变化说明已经是新的一局，清除上一局的识别结果
+                    context.reset()
+                    context.earth_shifting = earth_shifting
+                context.nightlord = nightlord
+                context.nightlord_score = score
+                context.nightlord_matched = True
 
         # 校准偏移
-        map_bg = open_cv2_image(f"maps_poi_match/{MAG_BG_FOR_POI_MATCH_INDEX_MAP[earth_shifting]}.jpg")
-        map_bg = cv2.resize(map_bg, STD_MAP_SIZE, interpolation=CV2_RESIZE_METHOD)
         try:
             align_t = time.time()
-            ALIGN_REGION = (
-                int(STD_MAP_SIZE[0] * 0.2),
-                int(STD_MAP_SIZE[1] * 0.2),
-                int(STD_MAP_SIZE[0] * 0.6),
-                int(STD_MAP_SIZE[1] * 0.6),
-            )
-            img = align_image(img, map_bg, ALIGN_REGION)
+            img = self._align_map_image(img, MAG_BG_FOR_POI_MATCH_INDEX_MAP[earth_shifting])
             info(f"MapDetector: Align map image time cost: {time.time() - align_t:.4f}s")
         except Exception as e:
             warning(f"MapDetector: Align map image failed: {e}")
 
+        # 候选地图模式评分矩阵
+        config = Config.get()
+        matrix = self.info.pattern_score_matrices.get((earth_shifting, nightlord))
+        if matrix is None:
+            warning(f"MapDetector: No map pattern for earth shifting {earth_shifting} and nightlord {nightlord}")
+            return []
+
+        all_poi_pos = matrix.positions
+        pos_index = { pos: j for j, pos in enumerate(all_poi_pos) }
+        scores = np.zeros(len(matrix.patterns), dtype=np.int32)
+        errors = np.zeros(len(matrix.patterns), dtype=np.int32)
+
+        # 识别当天的缩圈位置，缩圈不在该位置的地图模式增加误差（而不是直接排除，避免一次误识别排除正确结果）
+        if day in (1, 2):
+            get_circle_pos = (lambda p: p.day1_pos) if day == 1 else (lambda p: p.day2_pos)
+            night_circle_pos = context.night_circle_pos.get(day) if context is not None else None
+            if night_circle_pos is None:
+                circle_positions = sorted({ get_circle_pos(p) for p in matrix.patterns })
+                night_circle_pos, _ = self._match_night_circle(img, circle_positions)
+                if context is not None and night_circle_pos is not None:
+                    context.night_circle_pos[day] = night_circle_pos
+            if night_circle_pos is not None:
+                mismatch = np.array([get_circle_pos(p) != night_circle_pos for p in matrix.patterns], dtype=bool)
+                errors[mismatch] += NIGHT_CIRCLE_MISMATCH_ERROR
+                info(f"MapDetector: Day{day} night circle at {night_circle_pos}, {len(mismatch) - mismatch.sum()} of {len(mismatch)} patterns match")
+
+        probed = np.zeros(len(all_poi_pos), dtype=bool)
+
         # 识别POI
+        poi_bank = self._get_poi_template_bank(earth_shifting)
         poi_result: dict[Position, int] = {}
         poi_result_img = img.copy()    # for debug
 
-        all_poi_pos = set() # 收集所有待匹配POI点
-        nightlords = [nightlord] if nightlord is not None else self.info.all_nightlords
-        for nl in nightlords:
-            all_poi_pos.update(self.info.all_poi_pos.get((earth_shifting, nl), set()))
-
-        ratio = Config.get().poi_match_sample_ratio_w_nightlord if nightlord is not None else Config.get().poi_match_sample_ratio_wo_nightlord
-        sample_num = max(8, int(len(all_poi_pos) * ratio))  # 最少采样8个POI点
-        all_poi_pos = list(all_poi_pos)
-        random.shuffle(all_poi_pos)
-
-        for x, y in sorted(all_poi_pos[:sample_num]):
-            ctype, score = self._match_poi(img, map_bg, (x, y), earth_shifting, nightlord)
-            poi_result[(x, y)] = ctype
-
+        def add_poi_results(results: dict[Position, int]):
+            # 增量更新各地图模式的分数和误差
+            if not results:
+                return
+            poi_result.update(results)
+            cols = np.array([pos_index[pos] for pos in results], dtype=np.int32)
+            probed[cols] = True
+            score, error = get_poi_match_score_error(matrix, cols, np.array(list(results.values()), dtype=np.int32))
+            scores[:] += score.sum(axis=1)
+            errors[:] += error.sum(axis=1)
+
+        # 重新校验少量已识别的POI点，全部一致则复用其余结果，否则全部重新识别
+        cached_poi_results = context.poi_results if context is not None else {}
+        cached_poi_pos = [pos for pos in all_poi_pos if pos in cached_poi_results]
+        if cached_poi_pos:
+            step = max(1, len(cached_poi_pos) // CONTEXT_REVERIFY_POI_NUM)
+            reverify_poi_pos = cached_poi_pos[::step][:CONTEXT_REVERIFY_POI_NUM]
+            reverify_result = self._match_pois(img, poi_bank, reverify_poi_pos, earth_shifting, nightlord)
+            add_poi_results(reverify_result)
+            if all(reverify_result[pos] == cached_poi_results[pos] for pos in reverify_poi_pos):
+                add_poi_results({ pos: cached_poi_results[pos] for pos in cached_poi_pos if pos not in poi_result })
+                info(f"MapDetector: Reuse {len(cached_poi_pos)} poi results from context after reverifying {len(reverify_poi_pos)}")
+            else:
+                warning(f"MapDetector: Poi results in context mismatch, rematch all poi")
+                cached_poi_results.clear()
+
+        # 每轮选择最能区分剩余候选地图模式的POI点进行匹配，匹配数量达到下限且最佳结果确定后提前结束
+        # 选点时只考虑可能成为最佳结果的模式
+        ratio = config.poi_match_sample_ratio_w_nightlord if nightlord is not None else config.poi_match_sample_ratio_wo_nightlord
+        max_probe_num = max(MIN_POI_PROBE_NUM, int(len(all_poi_pos) * ratio))
+        batch_size = max(1, min(config.poi_match_workers, os.cpu_count() or 1))
+        margin = config.poi_probe_error_margin
+        min_probe_num = min(MIN_POI_PROBE_NUM, len(all_poi_pos))
+        k = len(scores) if topk is None else min(topk, len(scores))
+        probe_num = 0
+        while k > 0 and probe_num < max_probe_num:
+            probed_num = probed.sum()
+            if probed_num >= min_probe_num and is_best_determined(errors, margin):
+                break
+            # 误差已超出最佳结果加安全余量的模式视为不可能成为最佳结果，不再参与选点
+            alive = errors <= errors.min() + margin
+            cols = np.flatnonzero(~probed)
+            gains = get_split_entropy(matrix.ctype_codes[alive][:, cols], matrix.ctype_code_num)
+            if (gains > 0).any():
+                cols, gains = cols[gains > 0], gains[gains > 0]
+                cols = cols[np.lexsort((cols, -gains))]
+            elif probed_num >= min_probe_num or len(cols) == 0:
+                break   # 剩余POI点无法再区分候选模式
+            # 否则还未达到最少匹配数量，按顺序补足剩余的POI点
+            cols = cols[:min(batch_size, max_probe_num - probe_num)]
+            probe_poi_pos = [all_poi_pos[j] for j in cols]
+            add_poi_results(self._match_pois(img, poi_bank, probe_poi_pos, earth_shifting, nightlord))
+            probe_num += len(probe_poi_pos)
+        info(f"MapDetector: Match {probe_num} of {len(all_poi_pos)} poi points")
+
+        for (x, y), ctype in poi_result.items():
             # 绘制调试图
             paste_cv2(poi_result_img, np.array(self.all_poi_images[ctype])[..., :3], (x-STD_POI_SIZE[0]//2, y-STD_POI_SIZE[1]//2))
             cv2.circle(poi_result_img, (x, y), 2, (255, 0, 0), 3)
 
+        if context is not None:
+            context.poi_results.update(poi_result)
+
         # 保存结果用于调试
         cv2.imwrite(get_appdata_path(f"map.jpg"), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
         cv2.imwrite(get_appdata_path(f"map_poi_result.jpg"), cv2.cvtColor(poi_result_img, cv2.COLOR_RGB2BGR))
 
-        # 匹配地图模式
-        EMPTY_CONSTRUCTION = Construct(type=0, pos=0, is_display=False)
-        results: list[MapPatternMatchResult] = []
-        for pattern in self.info.patterns:
-            if pattern.earth_shifting != earth_shifting:
-                continue
-            if nightlord is not None and pattern.nightlord != nightlord:
-                continue
-            score, error = 0, 0
-            for pos, ctype in poi_result.items():
-                expect_ctype = pattern.pos_constructions.get(pos, EMPTY_CONSTRUCTION).type
-                if expect_ctype not in self.all_poi_images:
-                    expect_ctype = 0
-
-                subicon = CTYPE_SUBICON_MAP.get(ctype)
-                expect_subicon = CTYPE_SUBICON_MAP.get(expect_ctype)
-
-                if not has_same_base_icon(ctype, expect_ctype):   # 建筑类型不符合
-                    if subicon == expect_subicon:
-                        score += 1      # 子图标符合
-                        error += 3
-                    else:
-                        score += 0
-                        error += 10
-                else:
-                    if subicon == expect_subicon:
-                        score += 10     # 完全符合 
-                        error += 0
-                    elif subicon or expect_subicon:
-                        score += 0  # 一个有子图标一个没有
-                        error += 10
-                    else:
-                        score += 3      # 子图标不符合
-                        error += 1
-
-            # info(f"pattern {pattern.id} match score: {score} error: {error}")
-            results.append(MapPatternMatchResult(
-                pattern=pattern,
+        # 使用Error最小的结果，Error相同时Score大的优先，再相同时按模式顺序
+        sort_key = (errors.astype(np.int64) * (scores.max(initial=0) + 1) - scores) * len(scores) + np.arange(len(scores))
+        top = np.argpartition(sort_key, k - 1)[:k] if k > 0 else np.zeros(0, dtype=np.int64)
+        top = top[np.argsort(sort_key[top])]
+        best_patterns_by_error = [
+            MapPatternMatchResult(
+                pattern=matrix.patterns[i],
                 nightlord=nightlord,
-                score=score,
-                error=error,
-            ))
-
-        # 使用Error最小的结果
-        results = sorted(results, key=lambda x: (x.error, -x.score))
-        best_patterns_by_error = results[:topk]
+                score=int(scores[i]),
+                error=int(errors[i]),
+            ) for i in top
+        ]
         info(f"Match map pattern: return {[p.pattern.id for p in best_patterns_by_error]}, time cost: {time.time() - t:.4f}s")
         return best_patterns_by_error
 
@@ -878,37 +1525,74 @@ class MapDetector:
 
         return img
 
-    def detect(self, sct: MSSBase, param: MapDetectParam | None) -> MapDetectResult:
+    def get_capture_region(self, param: MapDetectParam | None) -> tuple[int] | None:
+        if param is None or param.map_region is None or param.frame is not None or param.img is not None:
+            return None
+        if param.do_match_full_map and not (param.do_match_earth_shifting or param.do_match_pattern):
+            return get_map_sub_region(param.map_region, CHECK_FULL_MAP_REGION)
+        return param.map_region
+
+    def detect(self, sct: CaptureBackend, param: MapDetectParam | None) -> MapDetectResult:
         config = Config.get()
         ret = MapDetectResult()
         if param is None or param.map_region is None:
             return ret
         
-        if param.img is None:
+        full_map_cache_key = None
+        if param.frame is not None:
+            frame = param.frame
+        elif param.img is not None:
+            frame = MapFrame(param.img)
+        else:
             # 根据参数选择图像处理方式
             processing = 'normalize' if param.hdr_processing_enabled else 'none'
-            img = grab_region(sct, param.map_region, processing=processing)
-            img = np.array(img)
-        else:
-            img = param.img
-        ret.img = img
+            if param.do_match_full_map and not (param.do_match_earth_shifting or param.do_match_pattern):
+                # 只判断是否是全图时只截取判断用的角落区域
+                region = get_map_sub_region(param.map_region, CHECK_FULL_MAP_REGION)
+                img = grab_region(sct, region, as_array=True)
+                # 截图未变化时复用上次结果，此时不返回图像
+                full_map_cache_key = (get_image_fingerprint(img), region, processing, config.full_map_match_method)
+                if config.skip_unchanged_frame_detect and (is_full_map := self.last_full_map_result.get(full_map_cache_key)) is not None:
+                    ret.is_full_map = is_full_map
+                    return ret
+                img = process_image(img, processing, region)
+                frame = MapFrame(cv2.cvtColor(img, cv2.COLOR_BGRA2RGB), region=CHECK_FULL_MAP_REGION)
+            else:
+                img = grab_region(sct, param.map_region, processing=processing, as_array=True)
+                frame = MapFrame(cv2.cvtColor(img, cv2.COLOR_BGRA2RGB))
+        ret.frame = frame
+        ret.img = frame.img
 
         # 判断是否是全图
         if param.do_match_full_map:
-            full_map_error = self._match_full_map(img)
-            ret.is_full_map = full_map_error <= config.full_map_error_threshold
+            ret.is_full_map = self._match_full_map(frame, config)
+            if full_map_cache_key is not None:
+                self.last_full_map_result.set(full_map_cache_key, ret.is_full_map)
 
         # 判断特殊地形
         if param.do_match_earth_shifting:
-            earth_shifting, earth_shifting_score = self._match_earth_shifting(img)
+            context = param.context
+            earth_shifting, earth_shifting_score = None, float('inf')
+            if context is not None and context.earth_shifting is not None:
+                # 同一局内优先只校验已识别的特殊地形
+                earth_shifting, earth_shifting_score = self._match_earth_shifting(frame, [context.earth_shifting])
+            if earth_shifting_score > config.earth_shifting_error_threshold:
+                earth_shifting, earth_shifting_score = self._match_earth_shifting(frame)
             if earth_shifting_score > config.earth_shifting_error_threshold:
                 earth_shifting = None
+            elif context is not None and earth_shifting != context.earth_shifting:
+                if context.earth_shifting is not None:
+                    warning(f"MapDetector: Earth shifting changed from {context.earth_shifting} to {earth_shifting}, reset context")
+                context.reset()
+                context.earth_shifting = earth_shifting
             ret.earth_shifting = earth_shifting
             ret.earth_shifting_score = earth_shifting_score
 
         # 地图模式匹配
         if param.do_match_pattern:
-            results = self._match_map_pattern(img, param.earth_shifting, topk=param.return_pattern_topk)
+            results = self._match_map_pattern(
+                frame, param.earth_shifting, topk=param.return_pattern_topk, context=param.context, day=param.day,
+            )
 
             # 决定信息绘制大小
             if config.fixed_map_overlay_draw_size is not None:
@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 import csv
+import numpy as np
 
 Position = tuple[int, int]
 
@@ -41,6 +42,16 @@ class MapPattern:
     evpat_flag: int
     pos_constructions: dict[Position, Construct]
     
+@dataclass
+class PatternScoreMatrix:
+    patterns: list[MapPattern]      # 行对应的地图模式
+    positions: list[Position]       # 列对应的POI位置
+    expect_ctypes: np.ndarray       # (P, N) int32 预期建筑类型，非POI建筑为0
+    base_icon_codes: np.ndarray     # (P, N) int32 预期建筑的基础图标编码
+    subicon_codes: np.ndarray       # (P, N) int32 预期建筑的子图标编码，-1表示无子图标
+    ctype_codes: np.ndarray         # (P, N) int32 预期建筑类型在所有预期类型中的序号，用于统计类型分布
+    ctype_code_num: int             # 预期建筑类型的种类数
+
 @dataclass
 class MapInfo:
     name_dict: dict[int, str]
@@ -54,6 +65,7 @@ class MapInfo:
     all_poi_pos: dict[tuple[int, int], set[Position]]
     all_poi_construct_type: dict[tuple[int, int], set[int]]
     possible_poi_types: dict[tuple[int, int, Position], set[int]]
+    pattern_score_matrices: dict[tuple[int, int | None], PatternScoreMatrix]
 
     def get_name(self, map_id: int) -> str:
         return self.name_dict.get(map_id)
@@ -78,11 +90,57 @@ def tgh_original_to_std_coord(p: tuple[float, float]) -> Position:
     )
 
 
+def get_base_icon_code(ctypes: np.ndarray) -> np.ndarray:
+    """
+    计算建筑类型的基础图标编码，编码相同的两个类型使用相同的基础图标
+    """
+    ctypes = np.asarray(ctypes, dtype=np.int32)
+    # DLC建筑按前三位区分，其余按前两位区分，取负数避免两种编码冲突
+    return np.where(ctypes // 10000 == 5, ctypes // 100, -(ctypes // 1000) - 1).astype(np.int32)
+
+def get_subicon_code(ctypes: np.ndarray, ctype_subicon_codes: dict[int, int]) -> np.ndarray:
+    """
+    计算建筑类型的子图标编码，-1表示无子图标
+    """
+    ctypes = np.asarray(ctypes, dtype=np.int32)
+    codes = np.full(ctypes.shape, -1, dtype=np.int32)
+    for ctype, code in ctype_subicon_codes.items():
+        codes[ctypes == ctype] = code
+    return codes
+
+def build_pattern_score_matrix(
+    patterns: list[MapPattern],
+    positions: list[Position],
+    poi_ctypes: set[int],
+    ctype_subicon_codes: dict[int, int],
+) -> PatternScoreMatrix:
+    """
+    构建地图模式×POI位置的预期建筑类型矩阵及对应的图标编码矩阵
+    """
+    expect_ctypes = np.zeros((len(patterns), len(positions)), dtype=np.int32)
+    for i, pattern in enumerate(patterns):
+        for j, pos in enumerate(positions):
+            construct = pattern.pos_constructions.get(pos)
+            if construct is not None and construct.type in poi_ctypes:
+                expect_ctypes[i, j] = construct.type
+    ctypes, ctype_codes = np.unique(expect_ctypes, return_inverse=True)
+    return PatternScoreMatrix(
+        patterns=patterns,
+        positions=positions,
+        expect_ctypes=expect_ctypes,
+        base_icon_codes=get_base_icon_code(expect_ctypes),
+        subicon_codes=get_subicon_code(expect_ctypes, ctype_subicon_codes),
+        ctype_codes=ctype_codes.reshape(expect_ctypes.shape).astype(np.int32),
+        ctype_code_num=len(ctypes),
+    )
+
+
 def load_map_info(
     map_patterns_csv_path: str,
     constructs_csv_path: str,
     names_csv_path: str,
     positions_csv_path: str,
+    ctype_subicon_codes: dict[int, int] | None = None,
 ):
     with open(names_csv_path, 'r', encoding='utf-8') as f:
         f.readline()
@@ -178,6 +236,24 @@ def load_map_info(
                 if con.type not in all_poi_construct_ctypes:
                     possible_poi_types[(es, nightlord, pos)].add(0)
 
+    # 构建评分矩阵，nightlord为None时包含该地形下所有夜王的地图模式
+    poi_ctypes: set[int] = set()
+    for ctypes in all_poi_construct_type.values():
+        poi_ctypes.update(ctypes)
+    pattern_score_matrices: dict[tuple[int, int | None], PatternScoreMatrix] = {}
+    for es in all_earth_shiftings:
+        for nightlord in [*all_nightlords, None]:
+            nightlords = [nightlord] if nightlord is not None else all_nightlords
+            positions: set[Position] = set()
+            for nl in nightlords:
+                positions.update(all_poi_pos.get((es, nl), set()))
+            pattern_score_matrices[(es, nightlord)] = build_pattern_score_matrix(
+                [p for p in patterns if p.earth_shifting == es and p.nightlord in nightlords],
+                sorted(positions),
+                poi_ctypes,
+                ctype_subicon_codes or {},
+            )
+
     return MapInfo(
         name_dict=name_dict,
         pos_dict=pos_dict,
@@ -188,4 +264,5 @@ def load_map_info(
         all_poi_pos=all_poi_pos,
         all_poi_construct_type=all_poi_construct_type,
         possible_poi_types=possible_poi_types,
+        pattern_score_matrices=pattern_score_matrices,
     )
\ No newline at end of file
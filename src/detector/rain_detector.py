@@ -4,10 +4,10 @@ from dataclasses import dataclass
 from PIL import Image
 import time
 from PyQt6.QtGui import QPixmap
-from mss.base import MSSBase
 
 from src.config import Config
 from src.logger import info, warning, error, debug
+from src.detector.capture import CaptureBackend
 from src.detector.utils import grab_region
 
 
@@ -45,8 +45,8 @@ class RainDetector:
             t = time.time()
             config = Config.get()
 
-            img = grab_region(sct, hpcolor_region, processing='none')
-            hls = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2HLS)
+            img = grab_region(sct, hpcolor_region, processing='none', as_array=True)
+            hls = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
 
             def calc_pixel_num(hls: np.ndarray, c1: list[int], c2: list[int]) -> int:
                 lower = np.array([min(c1[i], c2[i]) for i in range(3)])
@@ -80,7 +80,12 @@ class RainDetector:
             error(f"Detect in rain error")
             return 0.0, 0.0
 
-    def detect(self, sct: MSSBase, params: RainDetectParam | None) -> RainDetectResult:
+    def get_capture_region(self, params: RainDetectParam | None) -> tuple[int] | None:
+        if params is None:
+            return None
+        return params.hpcolor_region
+
+    def detect(self, sct: CaptureBackend, params: RainDetectParam | None) -> RainDetectResult:
         config = Config.get()
         ret = RainDetectResult()
         if params is None or params.hpcolor_region is None:
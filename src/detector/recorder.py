@@ -0,0 +1,300 @@
+import cv2
+import os
+import glob
+import json
+import time
+import shutil
+import queue
+import threading
+import dataclasses
+import numpy as np
+from typing import Callable
+
+from src.logger import info, warning, error
+from src.detector.capture import CaptureBackend, crop_with_padding
+
+
+SESSION_RECORD_VERSION = 1
+SESSION_RECORD_QUEUE_SIZE = 64      # 等待写入的最大记录数，写入跟不上时丢弃新的截图
+SESSION_RECORD_PNG_COMPRESSION = 1  # PNG压缩等级，录制时优先保证速度
+SESSION_RECORD_META_FILE = "meta.json"
+SESSION_RECORD_MAX_SESSIONS = 5     # 保留的最近录制会话数
+SESSION_RECORD_CLOSE_TIMEOUT = 2.0  # 停止录制时等待写入线程结束的最长时间(秒)
+
+
+def get_segment_paths(path: str, index: int) -> tuple[str, str]:
+    """
+    获取分段的数据文件和索引文件路径
+    """
+    return os.path.join(path, f"{index:06d}.bin"), os.path.join(path, f"{index:06d}.jsonl")
+
+def get_record_value(value):
+    """
+    将检测结果中的值转换为可以写入json的值，不支持的值（图像等）返回None
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        values = [get_record_value(v) for v in value]
+        if all(v is not None for v in values):
+            return values
+    return None
+
+def get_results_record(results) -> dict:
+    """
+    将DetectResult中各检测器结果的简单字段转换为字典
+    """
+    record = {}
+    for field in dataclasses.fields(results):
+        result = getattr(results, field.name)
+        if result is None:
+            continue
+        record[field.name] = {
+            f.name: v for f in dataclasses.fields(result)
+            if (v := get_record_value(getattr(result, f.name))) is not None
+        }
+    return record
+
+
+def remove_old_sessions(root: str, keep: int):
+    """
+    删除 root 下较旧的录制会话目录，只保留最近的 keep 个
+    """
+    sessions = sorted(d for d in glob.glob(os.path.join(root, "*")) if os.path.isdir(d))
+    for session in sessions[:max(len(sessions) - keep, 0)]:
+        shutil.rmtree(session, ignore_errors=True)
+
+
+class SessionRecorder:
+    """
+    会话录制，在后台线程中将截取的区域画面（PNG压缩）和检测结果追加写入分段文件，
+    每段包含一个数据文件和一个索引文件，只保留最近的 max_segments 段。
+    每次录制写入 root 下以开始时间命名的新目录，不会覆盖之前（例如崩溃前）的录制
+    """
+    def __init__(self, root: str, monitors: list[dict], segment_seconds: float, max_segments: int):
+        name = time.strftime("%Y%m%d_%H%M%S")
+        self.path = os.path.join(root, name)
+        suffix = 1
+        while os.path.exists(self.path):
+            self.path = os.path.join(root, f"{name}_{suffix}")
+            suffix += 1
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.queue: queue.Queue = queue.Queue(maxsize=SESSION_RECORD_QUEUE_SIZE)
+        self.dropped_num = 0
+        self.error_num = 0
+
+        os.makedirs(root, exist_ok=True)
+        remove_old_sessions(root, SESSION_RECORD_MAX_SESSIONS - 1)
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, SESSION_RECORD_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"version": SESSION_RECORD_VERSION, "monitors": monitors}, f)
+
+        self.region_ids: dict[tuple[int], int] = {}
+        self.segment_indices: list[int] = []
+        self.segment_start_time: float | None = None
+        self.data_file = None
+        self.index_file = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        info(f"SessionRecorder: start recording to {self.path}")
+
+    def add_frame(self, region: tuple[int], bgra: np.ndarray):
+        """
+        记录一次截图，bgra 需要在之后不被修改（截图后端每次返回新的缓冲区）
+        """
+        self._put(("frame", time.time(), tuple(int(v) for v in region), bgra))
+
+    def add_results(self, results):
+        self._put(("result", time.time(), get_results_record(results)))
+
+    def close(self):
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=SESSION_RECORD_CLOSE_TIMEOUT)
+            except queue.Full:
+                warning(f"SessionRecorder: record queue is still full, stop without waiting")
+            self.thread.join(timeout=SESSION_RECORD_CLOSE_TIMEOUT)
+            if self.thread.is_alive():
+                warning(f"SessionRecorder: writer thread did not stop in {SESSION_RECORD_CLOSE_TIMEOUT}s")
+        info(f"SessionRecorder: stop recording, dropped {self.dropped_num} records, {self.error_num} write errors")
+
+    def _put(self, item: tuple):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped_num += 1
+
+    def _open_segment(self, t: float):
+        self._close_segment()
+        index = self.segment_indices[-1] + 1 if self.segment_indices else 0
+        data_path, index_path = get_segment_paths(self.path, index)
+        self.data_file = open(data_path, "wb")
+        self.index_file = open(index_path, "w", encoding="utf-8")
+        self.segment_indices.append(index)
+        self.segment_start_time = t
+        # 删除最旧的分段
+        while len(self.segment_indices) > self.max_segments:
+            for file in get_segment_paths(self.path, self.segment_indices.pop(0)):
+                os.remove(file)
+
+    def _close_segment(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = self.index_file = None
+
+    def _write(self, item: tuple):
+        kind, t = item[0], item[1]
+        if self.segment_start_time is None or t - self.segment_start_time >= self.segment_seconds:
+            self._open_segment(t)
+        if kind == "frame":
+            _, _, region, bgra = item
+            region_id = self.region_ids.setdefault(region, len(self.region_ids))
+            ok, data = cv2.imencode(".png", bgra, [cv2.IMWRITE_PNG_COMPRESSION, SESSION_RECORD_PNG_COMPRESSION])
+            if not ok:
+                warning(f"SessionRecorder: failed to encode frame of region {region}")
+                return
+            record = {
+                "type": "frame", "t": t, "region_id": region_id, "region": region,
+                "offset": self.data_file.tell(), "size": len(data),
+            }
+            self.data_file.write(data.tobytes())
+        else:
+            record = {"type": "result", "t": t, "results": item[2]}
+        self.index_file.write(json.dumps(record) + "\n")
+
+    def _run(self):
+        try:
+            while (item := self.queue.get()) is not None:
+                # 写入出错时继续取出后续记录，避免队列塞满后 close 阻塞
+                try:
+                    self._write(item)
+                except Exception as e:
+                    if self.error_num == 0:
+                        error(f"SessionRecorder: write record error: {e}")
+                    self.error_num += 1
+        finally:
+            self._close_segment()
+
+
+class RecordingCaptureBackend(CaptureBackend):
+    """
+    包装截图后端，将每次截图交给录制器记录
+    """
+    def __init__(self, backend: CaptureBackend, recorder: SessionRecorder):
+        self.backend = backend
+        self.recorder = recorder
+
+    @property
+    def monitors(self) -> list[dict]:
+        return self.backend.monitors
+
+    @property
+    def monitors_generation(self) -> int:
+        return self.backend.monitors_generation
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        bgra = self.backend.grab(region)
+        self.recorder.add_frame(region, bgra)
+        return bgra
+
+    def close(self):
+        self.backend.close()
+
+
+class TraceReplayCaptureBackend(CaptureBackend):
+    """
+    回放 SessionRecorder 录制的记录，将当前时间之前录制的各区域画面依次绘制到整个屏幕上再截取
+    时间从第一条记录开始计算，用法同 ReplayCaptureBackend
+    """
+    def __init__(self, path: str, clock: Callable[[], float] | None = None):
+        self.path = path
+        self.clock = clock if clock is not None else time.perf_counter
+        self.start_time = self.clock()
+
+        with open(os.path.join(path, SESSION_RECORD_META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self._monitors = meta["monitors"]
+
+        # 读取所有分段的索引
+        self.frames: list[tuple[float, str, dict]] = []
+        self.results: list[tuple[float, dict]] = []
+        for index_path in sorted(glob.glob(os.path.join(path, "*.jsonl"))):
+            data_path = index_path[:-len(".jsonl")] + ".bin"
+            with open(index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 录制中断时最后一行可能不完整
+                        continue
+                    if record["type"] == "frame":
+                        self.frames.append((record["t"], data_path, record))
+                    else:
+                        self.results.append((record["t"], record["results"]))
+        if not self.frames:
+            raise ValueError(f"No frames found in session record: {path}")
+        self.frames.sort(key=lambda x: x[0])
+        self.results.sort(key=lambda x: x[0])
+        self.first_time = self.frames[0][0]
+        self.timestamps = sorted(set(t - self.first_time for t, _, _ in self.frames))
+
+        screen = self._monitors[0]
+        self.screen_offset = (screen["left"], screen["top"])
+        self.screen: np.ndarray | None = None
+        self.next_frame_index = 0
+        info(f"TraceReplayCaptureBackend: load {len(self.frames)} frames, {len(self.results)} results from {path}")
+
+    @property
+    def monitors(self) -> list[dict]:
+        return self._monitors
+
+    def get_time(self) -> float:
+        return self.clock() - self.start_time
+
+    def seek(self, t: float):
+        """
+        跳转到录制开始后的第 t 秒
+        """
+        self.start_time = self.clock() - t
+
+    def get_results(self, t: float) -> dict | None:
+        """
+        获取第 t 秒之前最后一次录制的检测结果
+        """
+        ret = None
+        for result_t, results in self.results:
+            if result_t - self.first_time > t:
+                break
+            ret = results
+        return ret
+
+    def _update_screen(self, t: float):
+        screen = self._monitors[0]
+        # 时间倒退时从头开始绘制
+        if self.screen is None or (self.next_frame_index > 0 and self.frames[self.next_frame_index - 1][0] - self.first_time > t):
+            self.screen = np.zeros((screen["height"], screen["width"], 4), dtype=np.uint8)
+            self.next_frame_index = 0
+        while self.next_frame_index < len(self.frames) and self.frames[self.next_frame_index][0] - self.first_time <= t:
+            _, data_path, record = self.frames[self.next_frame_index]
+            with open(data_path, "rb") as f:
+                f.seek(record["offset"])
+                data = f.read(record["size"])
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            x, y, w, h = record["region"]
+            x, y = x - self.screen_offset[0], y - self.screen_offset[1]
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, self.screen.shape[1]), min(y + h, self.screen.shape[0])
+            if x0 < x1 and y0 < y1:
+                self.screen[y0:y1, x0:x1] = img[y0-y:y1-y, x0-x:x1-x]
+            self.next_frame_index += 1
+
+    def grab(self, region: tuple[int]) -> np.ndarray:
+        self._update_screen(self.get_time())
+        x, y, w, h = region
+        region = (x - self.screen_offset[0], y - self.screen_offset[1], w, h)
+        return crop_with_padding(self.screen, region).copy()
@@ -1,10 +1,14 @@
 import cv2
+import os
+import hashlib
 import numpy as np
+from dataclasses import dataclass
 from PIL import Image, ImageDraw, ImageFont
-from mss.base import MSSBase
 
 from src.common import get_data_path
-from src.logger import warning, debug
+from src.config import Config
+from src.detector.capture import CaptureBackend, CaptureFrame
+from src.logger import info, warning, debug
 
 
 def hls_to_rgb(hls: tuple[int, int, int]) -> tuple[int, int, int]:
@@ -12,7 +16,21 @@ def hls_to_rgb(hls: tuple[int, int, int]) -> tuple[int, int, int]:
     img = cv2.cvtColor(img, cv2.COLOR_HLS2RGB)
     return tuple(int(c) for c in img[0][0])
 
-def normalize_image(img: Image.Image) -> Image.Image:
+NORMALIZE_CLAHE_CLIP_LIMIT = 2.0
+NORMALIZE_CLAHE_TILE_GRID_SIZE = (8, 8)
+
+clahe_cache: dict[tuple, cv2.CLAHE] = {}
+
+def get_clahe(clip_limit: float, tile_grid_size: tuple[int, int]) -> cv2.CLAHE:
+    """
+    获取缓存的CLAHE对象，相同参数只创建一次
+    """
+    key = (clip_limit, tuple(tile_grid_size))
+    if key not in clahe_cache:
+        clahe_cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    return clahe_cache[key]
+
+def normalize_image(img: Image.Image | np.ndarray) -> Image.Image | np.ndarray:
     """
     对图像进行归一化处理
     在HDR模式下，Windows截图API可能返回不同亮度范围的数据，
@@ -21,52 +39,50 @@ def normalize_image(img: Image.Image) -> Image.Image:
     这个函数通过归一化将图像的亮度和对比度标准化，
     使用直方图均衡化和对比度拉伸来提高匹配准确性。
     适用于：地图识别等需要增强局部对比度的场景
+    传入numpy数组时视为BGRA，返回BGRA数组
     """
-    # 将PIL图像转换为numpy数组
-    img_array = np.array(img)
+    is_array = isinstance(img, np.ndarray)
+    img_array = img if is_array else np.asarray(img)
     
     # 转换到LAB色彩空间，只对亮度通道进行归一化
-    lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
-    l, a, b = cv2.split(lab)
+    lab = cv2.cvtColor(img_array, cv2.COLOR_BGR2LAB if is_array else cv2.COLOR_RGB2LAB)
     
     # 对L通道进行CLAHE (对比度受限的自适应直方图均衡化)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    l_normalized = clahe.apply(l)
+    clahe = get_clahe(NORMALIZE_CLAHE_CLIP_LIMIT, NORMALIZE_CLAHE_TILE_GRID_SIZE)
+    cv2.insertChannel(clahe.apply(cv2.extractChannel(lab, 0)), lab, 0)
     
-    # 合并通道
-    lab_normalized = cv2.merge([l_normalized, a, b])
-    
-    # 转换回RGB
-    img_normalized = cv2.cvtColor(lab_normalized, cv2.COLOR_LAB2RGB)
-    
-    return Image.fromarray(img_normalized)
+    # 转换回原来的色彩空间
+    if is_array:
+        return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dstCn=4)
+    return Image.fromarray(cv2.cvtColor(lab, cv2.COLOR_LAB2RGB))
+
+
+# 使用2.2作为标准SDR gamma值 (通常HDR使用更高的gamma值)
+HDR_TO_SDR_GAMMA = 2.2
 
-def convert_hdr_to_sdr(img: Image.Image) -> Image.Image:
+def get_hdr_to_sdr_lut(gamma: float) -> np.ndarray:
+    """
+    预先计算HDR到SDR转换的查找表，计算方式与逐像素的gamma校正一致
+    """
+    values = np.arange(256, dtype=np.float32) / 255.0
+    values = np.clip(np.power(values, 1.0 / gamma), 0.0, 1.0)
+    return (values * 255).astype(np.uint8)
+
+HDR_TO_SDR_LUT = get_hdr_to_sdr_lut(HDR_TO_SDR_GAMMA)
+
+def convert_hdr_to_sdr(img: Image.Image | np.ndarray) -> Image.Image | np.ndarray:
     """
     将HDR色彩空间的图像转换为SDR色彩空间
     在HDR模式下，Windows截图API可能返回HDR色彩空间的数据，
     导致颜色过亮或不正确，影响模板匹配。
     
     这个函数通过色调映射（tone mapping）将HDR图像转换为SDR图像。
-    使用简单的gamma校正和亮度调整来实现基本的色调映射。
+    使用gamma校正的查找表逐通道处理，传入numpy数组时返回相同通道顺序的数组。
     适用于：缩圈倒计时检测等需要保持颜色准确性的场景
     """
-    # 将PIL图像转换为numpy数组
-    img_array = np.array(img, dtype=np.float32) / 255.0
-    
-    # 应用gamma校正 (通常HDR使用更高的gamma值)
-    # 使用2.2作为标准SDR gamma值
-    gamma = 2.2
-    img_array = np.power(img_array, 1.0 / gamma)
-    
-    # 限制亮度范围，避免过曝
-    # HDR内容可能包含超过1.0的亮度值
-    img_array = np.clip(img_array, 0.0, 1.0)
-    
-    # 转换回uint8
-    img_array = (img_array * 255).astype(np.uint8)
-    
-    return Image.fromarray(img_array)
+    if isinstance(img, np.ndarray):
+        return cv2.LUT(img, HDR_TO_SDR_LUT)
+    return Image.fromarray(cv2.LUT(np.asarray(img), HDR_TO_SDR_LUT))
     
 def get_size_by_height(size: tuple[int], target_height: int) -> tuple[int]:
     width, height = size
@@ -88,6 +104,15 @@ def resize_by_width_keep_aspect_ratio(image: Image.Image, target_width: int) ->
     target_size = get_size_by_width(image.size, target_width)
     return image.resize(target_size, Image.Resampling.LANCZOS)
 
+def resize_array_by_height(image: np.ndarray, target_height: int, interpolation: int | None = None) -> np.ndarray:
+    """
+    numpy数组版本的 resize_by_height_keep_aspect_ratio，默认缩小时用INTER_AREA，放大时用INTER_CUBIC
+    """
+    if interpolation is None:
+        interpolation = cv2.INTER_AREA if target_height < image.shape[0] else cv2.INTER_CUBIC
+    target_size = get_size_by_height((image.shape[1], image.shape[0]), target_height)
+    return cv2.resize(image, target_size, interpolation=interpolation)
+
 def resize_by_scale(image: Image.Image, scale: float) -> Image.Image:
     target_size = (int(image.size[0] * scale), int(image.size[1] * scale))
     return image.resize(target_size, Image.Resampling.LANCZOS)
@@ -97,103 +122,224 @@ def paste_cv2(img1: np.ndarray, img2: np.ndarray, pos: tuple[int, int]):
     h, w = img2.shape[0], img2.shape[1]
     img1[y:y+h, x:x+w] = img2
 
-def grab_region(sct: MSSBase, region: tuple[int], processing: str = 'none') -> Image.Image:
+def process_image(img: Image.Image | np.ndarray, processing: str, region: tuple[int] | None = None) -> Image.Image | np.ndarray:
     """
-    截取屏幕区域并可选地进行图像处理
-    
-    Args:
-        sct: 截图对象
-        region: 截图区域 (x, y, w, h)
-        processing: 图像处理方式
-            - 'none': 不进行任何处理（默认）
-            - 'normalize': 使用归一化处理（适用于地图识别）
-            - 'hdr_to_sdr': 使用HDR到SDR转换（适用于缩圈倒计时）
+    对截图进行图像处理，processing 取值同 grab_region，numpy数组视为BGRA
+    """
+    if processing == 'normalize':
+        debug(f"Applying image normalization for region {region}")
+        img = normalize_image(img)
+    elif processing == 'hdr_to_sdr':
+        debug(f"Applying HDR to SDR conversion for region {region}")
+        img = convert_hdr_to_sdr(img)
+    # processing == 'none' 时不做任何处理
+    return img
+
+@dataclass(frozen=True)
+class ResolvedRegion:
+    region: tuple[int]              # 原始区域
+    absolute_region: tuple[int]     # 包含屏幕偏移的绝对坐标
+    monitor_index: int | None       # 所在屏幕在 monitors 中的序号，找不到时为None
+
+
+def get_monitor_index(monitors: list[dict], x: int, y: int) -> int | None:
+    for i, monitor in enumerate(monitors[1:], start=1):  # 跳过 monitors[0] (所有屏幕的汇总)
+        if (monitor["left"] <= x < monitor["left"] + monitor["width"] and
+                monitor["top"] <= y < monitor["top"] + monitor["height"]):
+            return i
+    return None
+
+def resolve_region(monitors: list[dict], region: tuple[int]) -> ResolvedRegion:
+    """
+    将截图区域转换为包含屏幕偏移的绝对坐标
     """
-    from src.config import Config
-    
     x, y, w, h = region
-    
+
     # 首先检查坐标是否已经是绝对坐标（包含屏幕偏移）
     # 如果坐标在任何屏幕的范围内，直接使用
-    for monitor in sct.monitors[1:]:  # 跳过 monitors[0] (所有屏幕的汇总)
-        if (monitor["left"] <= x < monitor["left"] + monitor["width"] and
-                monitor["top"] <= y < monitor["top"] + monitor["height"]):
-            # 坐标已经是绝对坐标，直接截图
-            screenshot = sct.grab({
-                "left": x,
-                "top": y,
-                "width": w,
-                "height": h
-            })
-            img = Image.frombytes("RGB", screenshot.size, screenshot.bgra,
-                                  "raw", "BGRX")
-            
-            # 根据processing参数进行图像处理
-            if processing == 'normalize':
-                debug(f"Applying image normalization for region {region}")
-                img = normalize_image(img)
-            elif processing == 'hdr_to_sdr':
-                debug(f"Applying HDR to SDR conversion for region {region}")
-                img = convert_hdr_to_sdr(img)
-            # processing == 'none' 时不做任何处理
-            
-            return img
+    if (index := get_monitor_index(monitors, x, y)) is not None:
+        return ResolvedRegion(region, region, index)
     
     # 如果没有找到匹配的屏幕，可能是相对坐标，尝试转换为绝对坐标
     # 默认使用主屏幕偏移（保持向后兼容）
-    main_screen = sct.monitors[1]
-    main_screen_offset = (main_screen["left"], main_screen["top"])
+    main_screen = monitors[1]
     absolute_region = (
-        x + main_screen_offset[0],
-        y + main_screen_offset[1],
+        x + main_screen["left"],
+        y + main_screen["top"],
         w,
         h,
     )
     
     # 验证转换后的坐标是否有效
-    abs_x, abs_y, abs_w, abs_h = absolute_region
-    for monitor in sct.monitors[1:]:
-        if (monitor["left"] <= abs_x < monitor["left"] + monitor["width"] and
-                monitor["top"] <= abs_y < monitor["top"] + monitor["height"]):
-            screenshot = sct.grab({
-                "left": abs_x,
-                "top": abs_y,
-                "width": abs_w,
-                "height": abs_h
-            })
-            img = Image.frombytes("RGB", screenshot.size, screenshot.bgra,
-                                  "raw", "BGRX")
-            
-            # 根据processing参数进行图像处理
-            if processing == 'normalize':
-                debug(f"Applying image normalization for region {region}")
-                img = normalize_image(img)
-            elif processing == 'hdr_to_sdr':
-                debug(f"Applying HDR to SDR conversion for region {region}")
-                img = convert_hdr_to_sdr(img)
-            
-            return img
-    
-    # 如果仍然找不到有效屏幕，使用原始逻辑作为最后的fallback
-    warning(f"Region {region} could not be mapped to any screen. "
-            f"Using fallback method.")
-    screenshot = sct.grab({
-        "left": abs_x,
-        "top": abs_y,
-        "width": abs_w,
-        "height": abs_h
-    })
-    img = Image.frombytes("RGB", screenshot.size, screenshot.bgra, "raw", "BGRX")
-    
-    # 根据processing参数进行图像处理
-    if processing == 'normalize':
-        debug(f"Applying image normalization for region {region}")
-        img = normalize_image(img)
-    elif processing == 'hdr_to_sdr':
-        debug(f"Applying HDR to SDR conversion for region {region}")
-        img = convert_hdr_to_sdr(img)
+    index = get_monitor_index(monitors, absolute_region[0], absolute_region[1])
+    if index is None:
+        # 如果仍然找不到有效屏幕，使用原始逻辑作为最后的fallback
+        warning(f"Region {region} could not be mapped to any screen. "
+                f"Using fallback method.")
+    return ResolvedRegion(region, absolute_region, index)
+
+
+class RegionResolver:
+    """
+    缓存区域的转换结果，区域只在用户重新框选时变化，
+    屏幕列表对象变化时比较屏幕布局，布局变化或截图后端重新获取屏幕列表时清空缓存
+    """
+    def __init__(self):
+        self.monitors: list[dict] | None = None
+        self.monitors_key: tuple | None = None
+        self.monitors_generation: int = 0
+        self.cache: dict[tuple[int], ResolvedRegion] = {}
+
+    def invalidate(self):
+        self.monitors = None
+        self.monitors_key = None
+        self.cache.clear()
+
+    def resolve(self, sct: CaptureBackend, region: tuple[int]) -> ResolvedRegion:
+        monitors = sct.monitors
+        if sct.monitors_generation != self.monitors_generation:
+            self.invalidate()
+            self.monitors_generation = sct.monitors_generation
+        if monitors is not self.monitors:
+            monitors_key = tuple((m["left"], m["top"], m["width"], m["height"]) for m in monitors)
+            if monitors_key != self.monitors_key:
+                if self.monitors_key is not None:
+                    info(f"Monitor layout changed, clear resolved regions")
+                self.cache.clear()
+                self.monitors_key = monitors_key
+            self.monitors = monitors
+        region = tuple(region)
+        if (resolved := self.cache.get(region)) is None:
+            resolved = resolve_region(monitors, region)
+            self.cache[region] = resolved
+        return resolved
+
+region_resolver = RegionResolver()
+
+
+def get_absolute_region(sct: CaptureBackend, region: tuple[int]) -> tuple[int]:
+    """
+    将截图区域转换为包含屏幕偏移的绝对坐标
+    """
+    return region_resolver.resolve(sct, region).absolute_region
+
+def resolve_regions(sct: CaptureBackend, regions: list[tuple[int] | None]) -> list[ResolvedRegion]:
+    """
+    转换多个截图区域，忽略为None的区域
+    """
+    return [region_resolver.resolve(sct, region) for region in regions if region is not None]
+
+def get_union_region(regions: list[tuple[int]]) -> tuple[int]:
+    """
+    获取包含所有区域的外接矩形
+    """
+    left = int(min(r[0] for r in regions))
+    top = int(min(r[1] for r in regions))
+    right = int(max(r[0] + r[2] for r in regions))
+    bottom = int(max(r[1] + r[3] for r in regions))
+    return (left, top, right - left, bottom - top)
+
+CAPTURE_REGION_MERGE_RATIO = 1.5  # 两个区域的外接矩形面积不超过两者面积之和的该倍数时合并截取
+
+def get_capture_regions(regions: list[tuple[int]]) -> list[tuple[int]]:
+    """
+    将相距较近的区域合并为外接矩形，相距较远的区域分开，减少截取无用的画面
+    """
+    def area(r: tuple[int]) -> int:
+        return r[2] * r[3]
+    clusters = [get_union_region([region]) for region in regions]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                union = get_union_region([clusters[i], clusters[j]])
+                if area(union) <= CAPTURE_REGION_MERGE_RATIO * (area(clusters[i]) + area(clusters[j])):
+                    clusters[i] = union
+                    clusters.pop(j)
+                    merged = True
+                    break
+            if merged:
+                break
+    return clusters
+
+def grab_frame(sct: CaptureBackend, regions: list[ResolvedRegion]) -> CaptureFrame | None:
+    """
+    截取包含所有区域的画面，相距较近的区域合并为一块截取。
+    regions 为已转换的区域，不再重复转换（否则无法对应到屏幕的区域会被再次加上主屏幕偏移）
+    """
+    regions = [region.absolute_region for region in regions]
+    if not regions:
+        return None
+    parts = []
+    for left, top, w, h in get_capture_regions(regions):
+        bgra = sct.grab((left, top, w, h))
+        parts.append(((left, top, bgra.shape[1], bgra.shape[0]), bgra))
+    return CaptureFrame(sct, parts)
+
+
+def grab_region(
+    sct: CaptureBackend, 
+    region: tuple[int], 
+    processing: str = 'none', 
+    as_array: bool = False,
+) -> Image.Image | np.ndarray:
+    """
+    截取屏幕区域并可选地进行图像处理
     
-    return img
+    Args:
+        sct: 截图后端，传入 CaptureFrame 时优先从已截取的画面中取出区域
+        region: 截图区域 (x, y, w, h)
+        processing: 图像处理方式
+            - 'none': 不进行任何处理（默认）
+            - 'normalize': 使用归一化处理（适用于地图识别）
+            - 'hdr_to_sdr': 使用HDR到SDR转换（适用于缩圈倒计时）
+        as_array: 返回 (h, w, 4) 的BGRA numpy数组而不是RGB的PIL图像，
+            不做处理时直接引用截图缓冲区，不复制也不重排通道
+    """
+    bgra = sct.grab(get_absolute_region(sct, region))
+    if as_array:
+        return process_image(bgra, processing, region)
+    img = Image.fromarray(cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB))
+    return process_image(img, processing, region)
+
+
+FINGERPRINT_STRIDE = 2  # 计算截图指纹时的像素采样间隔
+
+def get_image_fingerprint(img: Image.Image | np.ndarray) -> bytes:
+    """
+    计算截图的快速指纹，对间隔采样的像素取哈希，用于判断区域内容是否变化
+    """
+    arr = np.asarray(img)[::FINGERPRINT_STRIDE, ::FINGERPRINT_STRIDE]
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(repr(arr.shape).encode())
+    hasher.update(np.ascontiguousarray(arr).data)
+    return hasher.digest()
+
+class LastResultCache:
+    """
+    缓存上一次检测的结果，截图指纹和检测参数都与上次相同时复用该结果，
+    配置文件重新加载后（阈值等可能变化）缓存失效
+    """
+    def __init__(self):
+        self._key = None
+        self._result = None
+        self._config_mtime = None
+
+    def get(self, key: tuple):
+        if self._key is not None and key == self._key and self._config_mtime == Config.get_mtime():
+            return self._result
+        return None
+
+    def set(self, key: tuple, result):
+        self._key = key
+        self._result = result
+        self._config_mtime = Config.get_mtime()
+
+    def clear(self):
+        self._key = None
+        self._result = None
+        self._config_mtime = None
 
 
 DEFAULT_FONT_PATH = get_data_path("fonts/SourceHanSansSC-Normal.otf")
@@ -259,10 +405,179 @@ def match_template(
     return best_match, best_val
 
 
+class ImageAligner:
+    """
+    使用 SIFT 特征点匹配将图像对齐到固定的基准图。
+    基准图的特征点、描述子和 FLANN 索引只在创建时计算一次，可选缓存到磁盘，
+    每次对齐只需提取待变换图像的特征。
+    """
+    def __init__(self, target: np.ndarray, region: tuple[int, int, int, int], cache_path: str | None = None):
+        """
+        Args:
+            target: 对齐基准图
+            region: (x, y, w, h) 指定用于匹配的区域坐标
+            cache_path: 基准图特征的缓存文件路径，为None时不缓存
+        """
+        self.target_size = (target.shape[1], target.shape[0])
+        self.region = region
+        self.sift = cv2.SIFT_create()
+
+        # 每行为 (x, y, 128维描述子)，坐标为整张图上的坐标
+        features = None
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                features = np.load(cache_path)
+            except Exception as e:
+                warning(f"ImageAligner: Load features from {cache_path} failed: {e}")
+        if features is None:
+            features = self._compute_target_features(target)
+            if cache_path is not None:
+                try:
+                    tmp_path = cache_path + ".tmp.npy"
+                    np.save(tmp_path, features)
+                    os.replace(tmp_path, cache_path)
+                except Exception as e:
+                    warning(f"ImageAligner: Save features to {cache_path} failed: {e}")
+
+        if len(features) == 0:
+            raise ValueError("ImageAligner: No features found in target region.")
+        self.target_pts = np.ascontiguousarray(features[:, :2], dtype=np.float32)
+        self.matcher = cv2.FlannBasedMatcher(
+            dict(algorithm=1, trees=5), # FLANN_INDEX_KDTREE = 1
+            dict(checks=50),
+        )
+        self.matcher.add([np.ascontiguousarray(features[:, 2:], dtype=np.float32)])
+        self.matcher.train()
+
+    def _compute_target_features(self, target: np.ndarray) -> np.ndarray:
+        x, y, w, h = self.region
+        gray_target = cv2.cvtColor(target[y:y+h, x:x+w], cv2.COLOR_BGR2GRAY)
+        kp_target, des_target = self.sift.detectAndCompute(gray_target, None)
+        if des_target is None:
+            return np.zeros((0, 130), dtype=np.float32)
+        pts = np.float32([kp.pt for kp in kp_target]) + np.float32([x, y])
+        return np.hstack([pts, des_target]).astype(np.float32)
+
+    def align(self, img: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            img: 待变换的图像
+
+        Returns:
+            np.ndarray: 对齐后的图像，大小与基准图一致
+        """
+        x, y, w, h = self.region
+        gray_img = cv2.cvtColor(img[y:y+h, x:x+w], cv2.COLOR_BGR2GRAY)
+        kp_img, des_img = self.sift.detectAndCompute(gray_img, None)
+
+        if des_img is None:
+            raise ValueError("ImageAligner: No features found in region.")
+
+        matches = self.matcher.knnMatch(des_img, k=2)
+        good_matches = []
+        for m in matches:
+            if len(m) == 2 and m[0].distance < 0.7 * m[1].distance:
+                good_matches.append(m[0])
+
+        if len(good_matches) < 4:
+            raise ValueError(f"ImageAligner: Not enough matches found ({len(good_matches)}).")
+
+        src_pts = np.float32([kp_img[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+        dst_pts = self.target_pts[[m.trainIdx for m in good_matches]].reshape(-1, 1, 2)
+
+        src_pts[:, 0, 0] += x
+        src_pts[:, 0, 1] += y
+
+        matrix, mask = cv2.estimateAffinePartial2D(src_pts, dst_pts, method=cv2.RANSAC)
+
+        if matrix is not None:
+            aligned_img = cv2.warpAffine(
+                img, 
+                matrix, 
+                self.target_size, 
+                flags=cv2.INTER_LINEAR, 
+                borderMode=cv2.BORDER_CONSTANT, 
+                borderValue=0
+            )
+            return aligned_img
+        else:
+            raise ValueError("ImageAligner: Could not compute affine transformation matrix.")
+
+class PhaseCorrelationAligner:
+    """
+    使用相位相关将图像对齐到固定的基准图，只处理平移和小范围的均匀缩放。
+    先对频谱幅值做对数极坐标变换并相位相关求缩放，再在空间域相位相关求平移。
+    """
+    def __init__(self, target: np.ndarray, region: tuple[int, int, int, int]):
+        """
+        Args:
+            target: 对齐基准图
+            region: (x, y, w, h) 指定用于匹配的区域坐标
+        """
+        x, y, w, h = region
+        self.target_size = (target.shape[1], target.shape[0])
+        self.region = region
+        self.window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+        self.max_radius = min(w, h) / 2
+        self.log_base = w / np.log(self.max_radius)  # 对数极坐标每单位ln(r)对应的像素数
+        self.target_roi = self._get_roi(cv2.cvtColor(target, cv2.COLOR_BGR2GRAY).astype(np.float32))
+        self.target_log_polar = self._get_log_polar_spectrum(self.target_roi)
+
+    def _get_roi(self, gray: np.ndarray) -> np.ndarray:
+        x, y, w, h = self.region
+        return gray[y:y+h, x:x+w]
+
+    def _get_log_polar_spectrum(self, roi: np.ndarray) -> np.ndarray:
+        h, w = roi.shape
+        spectrum = np.fft.fftshift(np.abs(np.fft.fft2(roi * self.window)))
+        spectrum = np.log1p(spectrum).astype(np.float32)
+        return cv2.warpPolar(
+            spectrum, (w, h), (w / 2, h / 2), self.max_radius, 
+            cv2.WARP_POLAR_LOG | cv2.INTER_LINEAR,
+        )
+
+    def align(self, img: np.ndarray) -> tuple[np.ndarray, float]:
+        """
+        Args:
+            img: 待变换的图像
+
+        Returns:
+            tuple[np.ndarray, float]: 对齐后的图像(大小与基准图一致)和平移相位相关的峰值响应，
+                响应越低对齐结果越不可靠
+        """
+        x, y, w, h = self.region
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+        # 频谱幅值与平移无关，缩放在对数极坐标下变为沿半径方向的平移
+        (shift_rho, _), _ = cv2.phaseCorrelate(self.target_log_polar, self._get_log_polar_spectrum(self._get_roi(gray)))
+        scale = float(np.exp(shift_rho / self.log_base))
+
+        # 绕区域中心缩放后求剩余平移
+        cx, cy = x + w / 2, y + h / 2
+        matrix = np.float32([
+            [scale, 0, cx - scale * cx],
+            [0, scale, cy - scale * cy],
+        ])
+        scaled = cv2.warpAffine(gray, matrix, self.target_size, flags=cv2.INTER_LINEAR)
+        (dx, dy), response = cv2.phaseCorrelate(self.target_roi, self._get_roi(scaled), self.window)
+        matrix[0, 2] -= dx
+        matrix[1, 2] -= dy
+
+        aligned_img = cv2.warpAffine(
+            img, 
+            matrix, 
+            self.target_size, 
+            flags=cv2.INTER_LINEAR, 
+            borderMode=cv2.BORDER_CONSTANT, 
+            borderValue=0
+        )
+        return aligned_img, float(response)
+
 def align_image(img: np.ndarray, target: np.ndarray, region: tuple[int, int, int, int]) -> np.ndarray:
     """
     使用 SIFT 特征点匹配对齐两张图像。
     仅使用 region 区域内的图像进行特征点检测和匹配，返回对齐后的整张图像。
+    需要多次对齐到同一基准图时应使用 ImageAligner 复用基准图特征。
     
     Args:
         img: 待变换的图像 (图A)
@@ -272,54 +587,5 @@ def align_image(img: np.ndarray, target: np.ndarray, region: tuple[int, int, int
     Returns:
         np.ndarray: 对齐后的图像，大小与 target 一致
     """
-    x, y, w, h = region
-    
-    roi_img = img[y:y+h, x:x+w]
-    roi_target = target[y:y+h, x:x+w]
-
-    gray_img = cv2.cvtColor(roi_img, cv2.COLOR_BGR2GRAY)
-    gray_target = cv2.cvtColor(roi_target, cv2.COLOR_BGR2GRAY)
-
-    sift = cv2.SIFT_create()
-    kp_img, des_img = sift.detectAndCompute(gray_img, None)
-    kp_target, des_target = sift.detectAndCompute(gray_target, None)
-
-    if des_img is None or des_target is None:
-        raise ValueError("align_image: No features found in region.")
-
-    index_params = dict(algorithm=1, trees=5) # FLANN_INDEX_KDTREE = 1
-    search_params = dict(checks=50)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(des_img, des_target, k=2)
-    good_matches = []
-    for m, n in matches:
-        if m.distance < 0.7 * n.distance:
-            good_matches.append(m)
-
-    if len(good_matches) < 4:
-        raise ValueError(f"align_image: Not enough matches found ({len(good_matches)}).")
-
-    src_pts = np.float32([kp_img[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kp_target[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    
-    src_pts[:, 0, 0] += x
-    src_pts[:, 0, 1] += y
-    dst_pts[:, 0, 0] += x
-    dst_pts[:, 0, 1] += y
-
-    matrix, mask = cv2.estimateAffinePartial2D(src_pts, dst_pts, method=cv2.RANSAC)
-
-    if matrix is not None:
-        h_target, w_target = target.shape[:2]
-        aligned_img = cv2.warpAffine(
-            img, 
-            matrix, 
-            (w_target, h_target), 
-            flags=cv2.INTER_LINEAR, 
-            borderMode=cv2.BORDER_CONSTANT, 
-            borderValue=0
-        )
-        return aligned_img
-    else:
-        raise ValueError("align_image: Could not compute affine transformation matrix.")
+    return ImageAligner(target, region).align(img)
 
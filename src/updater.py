@@ -3,7 +3,7 @@ import time
 from enum import Enum
 from PIL import Image
 
-from src.common import GAME_WINDOW_TITLE
+from src.common import GAME_WINDOW_TITLE, get_appdata_path
 from src.config import Config
 from src.logger import info, warning, error
 from src.ui.input import InputWorker
@@ -16,6 +16,7 @@ from src.detector import (
     DayDetectParam,
     RainDetectParam,
     MapDetectParam,
+    MapRecognitionContext,
     HpDetectParam,
     ArtDetectParam,
 )
@@ -94,6 +95,7 @@ class Updater(QObject):
         self.map_overlay_visible: bool = False
         self.last_map_pattern_match_time: float = 0.0
         self.map_pattern_return_topk: int = 5
+        self.map_recognition_context = MapRecognitionContext()
 
         self.hp_overlay = hp_overlay
         self.hp_overlay_ui_state_signal.connect(self.hp_overlay.update_ui_state)
@@ -122,6 +124,8 @@ class Updater(QObject):
         self.current_phase = Phase.FIRST_CIRCLE_STABLE
         self.phase_start_time = self.get_time()
         info("Day 1 started.")
+        # 新的一局开始，之前识别的特殊地形、夜王和POI不再有效
+        self.map_recognition_context.reset()
         self.set_to_detect_map_pattern_once()
 
     def start_day2(self):
@@ -196,17 +200,24 @@ class Updater(QObject):
                 else:
                     self.phase_start_time = self.get_time()
 
+    def get_dayx_detect_param(self) -> DayDetectParam | None:
+        if not self.dayx_detect_enabled:
+            return None
+        return DayDetectParam(
+            day1_region=self.day1_detect_region,
+            lang=self.dayx_detect_lang,
+            hdr_processing_enabled=self.hdr_processing_enabled,
+        )
+
     def detect_and_update_dayx(self):
         if not self.dayx_detect_enabled:
             return
         param = DetectParam(
-            day_detect_param=DayDetectParam(
-                day1_region=self.day1_detect_region,
-                lang=self.dayx_detect_lang,
-                hdr_processing_enabled=self.hdr_processing_enabled,
-            )
+            day_detect_param=self.get_dayx_detect_param(),
         )
         result = self.detector.detect(param)
+        if (lang := result.day_detect_result.lang) is not None and lang != self.dayx_detect_lang:
+            warning(f"DAYX matched with lang {lang}, but current lang setting is {self.dayx_detect_lang}.")
         if result.day_detect_result.start_day1:
             self.start_day1()
         elif result.day_detect_result.start_day2:
@@ -242,18 +253,23 @@ class Updater(QObject):
         text = f"雨中冒险倒计时 {format_period(int(max(total - t, 0)))} - {percent}%"
         return progress, text
 
+    def get_in_rain_detect_param(self) -> RainDetectParam | None:
+        if not self.in_rain_detect_enabled:
+            return None
+        return RainDetectParam(
+            in_rain_hls=self.in_rain_hls,
+            not_in_rain_hls=self.not_in_rain_hls,
+            in_rain_hls_hdr=self.in_rain_hls_hdr,
+            not_in_rain_hls_hdr=self.not_in_rain_hls_hdr,
+            hpcolor_region=self.hpcolor_detect_region,
+            hdr_processing_enabled=self.hdr_processing_enabled,
+        )
+
     def detect_and_update_in_rain(self):
         if not self.in_rain_detect_enabled:
             return
         param = DetectParam(
-            rain_detect_param=RainDetectParam(
-                in_rain_hls=self.in_rain_hls,
-                not_in_rain_hls=self.not_in_rain_hls,
-                in_rain_hls_hdr=self.in_rain_hls_hdr,
-                not_in_rain_hls_hdr=self.not_in_rain_hls_hdr,
-                hpcolor_region=self.hpcolor_detect_region,
-                hdr_processing_enabled=self.hdr_processing_enabled,
-            )
+            rain_detect_param=self.get_in_rain_detect_param(),
         )
         result = self.detector.detect(param)
         is_in_rain = result.rain_detect_result.is_in_rain
@@ -328,22 +344,26 @@ class Updater(QObject):
         else:
             self.show_map_overlay()
 
+    def get_map_detect_param(self) -> MapDetectParam | None:
+        if not self.map_detect_enabled:
+            return None
+        return MapDetectParam(
+            map_region=self.map_region,
+            do_match_full_map=True,
+            hdr_processing_enabled=self.hdr_processing_enabled,
+        )
+
     def detect_and_update_map(self):
         if not self.map_detect_enabled:
             self.hide_map_overlay()
             return
    
         param = DetectParam(
-            map_detect_param=MapDetectParam(
-                map_region=self.map_region,
-                do_match_full_map=True,
-                hdr_processing_enabled=self.hdr_processing_enabled,
-            )
+            map_detect_param=self.get_map_detect_param(),
         )
         result = self.detector.detect(param)
 
         is_full_map = result.map_detect_result.is_full_map
-        map_img = result.map_detect_result.img
         if is_full_map is not None:
             if is_full_map and not self.current_is_full_map:
                 info("Current map changed to full map.")
@@ -368,15 +388,17 @@ class Updater(QObject):
 
         elif self.do_match_map_pattern_flag == DoMatchMapPatternFlag.TRUE and is_full_map:
             # 特殊地形识别成功才进行匹配（避免地图半透明时就识别）
+            # 平时只截取判断全图用的角落区域，只在此时截取完整地图
             result = self.detector.detect(DetectParam(
                 map_detect_param=MapDetectParam(
                     map_region=self.map_region,
-                    img=map_img,    # 使用之前截取的图片，避免处理过程中画面变化
                     do_match_earth_shifting=True,
                     hdr_processing_enabled=self.hdr_processing_enabled,
+                    context=self.map_recognition_context,
                 )
             ))
             earth_shifting = result.map_detect_result.earth_shifting
+            map_frame = result.map_detect_result.frame
             if earth_shifting is not None:
                 # 进行匹配
                 self.do_match_map_pattern_flag = DoMatchMapPatternFlag.FALSE
@@ -395,11 +417,13 @@ class Updater(QObject):
                 result = self.detector.detect(DetectParam(
                     map_detect_param=MapDetectParam(
                         map_region=self.map_region,
-                        img=map_img,
+                        frame=map_frame,    # 使用识别特殊地形时截取的图片，避免处理过程中画面变化，并复用缩放结果
                         earth_shifting=earth_shifting,
                         do_match_pattern=True,
                         hdr_processing_enabled=self.hdr_processing_enabled,
                         return_pattern_topk=self.map_pattern_return_topk,
+                        context=self.map_recognition_context,
+                        day=self.day,
                     )
                 ))
                 self.update_map_overlay_images(result.map_detect_result.overlay_images, earth_shifting=earth_shifting)
@@ -421,16 +445,21 @@ class Updater(QObject):
                 w=length,
             ))
 
+    def get_hp_detect_param(self) -> HpDetectParam | None:
+        if not self.hp_detect_enabled:
+            return None
+        return HpDetectParam(
+            hpbar_region=self.hpbar_region,
+            keep_last_valid=self.hp_detect_keep_last_valid,
+        )
+
     def detect_and_update_hp(self):
         if not self.hp_detect_enabled:
             self.update_hp_length(None)
             return
         
         param = DetectParam(
-            hp_detect_param=HpDetectParam(
-                hpbar_region=self.hpbar_region,
-                keep_last_valid=self.hp_detect_keep_last_valid,
-            )
+            hp_detect_param=self.get_hp_detect_param(),
         )
         result = self.detector.detect(param)
 
@@ -446,17 +475,22 @@ class Updater(QObject):
         self.to_detect_art_time = self.get_time() + config.art_detect_delay_seconds
         info(f"Will detect art in {config.art_detect_delay_seconds} seconds.")
     
-    def detect_and_update_art(self):
+    def get_art_detect_param(self) -> ArtDetectParam | None:
         if not self.art_detect_enabled or \
             self.to_detect_art_time is None or self.get_time() < self.to_detect_art_time:
-            return
-        
+            return None
+        return ArtDetectParam(
+            art_region=self.art_region,
+            hdr_processing_enabled=self.hdr_processing_enabled,
+        )
+
+    def detect_and_update_art(self):
         param = DetectParam(
-            art_detect_param=ArtDetectParam(
-                art_region=self.art_region,
-                hdr_processing_enabled=self.hdr_processing_enabled,
-            )
+            art_detect_param=self.get_art_detect_param(),
         )
+        if param.art_detect_param is None:
+            return
+
         result = self.detector.detect(param)
         self.to_detect_art_time = None
         
@@ -491,12 +525,30 @@ class Updater(QObject):
         
     # =============== Main Loop =============== #
 
+    def capture_detect_frame(self):
+        """
+        截取本轮所有检测共用的一帧画面
+        """
+        # 只截取判断全图用的角落区域，打开全图后识别特殊地形时再单独截取完整地图
+        self.detector.capture(DetectParam(
+            day_detect_param=self.get_dayx_detect_param(),
+            rain_detect_param=self.get_in_rain_detect_param(),
+            map_detect_param=self.get_map_detect_param(),
+            hp_detect_param=self.get_hp_detect_param(),
+            art_detect_param=self.get_art_detect_param(),
+        ))
+
     def detect_and_update_all(self):
-        self.detect_and_update_dayx()
-        self.detect_and_update_in_rain()
-        self.detect_and_update_map()
-        self.detect_and_update_hp()
-        self.detect_and_update_art()
+        if Config.get().shared_frame_capture:
+            self.capture_detect_frame()
+        try:
+            self.detect_and_update_dayx()
+            self.detect_and_update_in_rain()
+            self.detect_and_update_map()
+            self.detect_and_update_hp()
+            self.detect_and_update_art()
+        finally:
+            self.detector.release_frame()
 
     def check_game_foreground(self) -> bool:
         is_foreground = is_window_in_foreground(GAME_WINDOW_TITLE)
@@ -521,6 +573,11 @@ class Updater(QObject):
             self._running = True
             info("Updater started.")
 
+            if Config.get().session_record_enabled:
+                self.detector.start_recording(get_appdata_path("session_record"))
+            if Config.get().capture_thread_enabled:
+                self.detector.start_capture_thread(self.detect_interval)
+
             last_detect_time = 0
             while self._running:
                 start_time = self.get_time()
@@ -529,7 +586,11 @@ class Updater(QObject):
 
                 if self.get_time() - last_detect_time > self.detect_interval:
                     if not self.only_detect_when_game_foreground or is_game_foreground:
+                        self.detector.set_capture_interval(self.detect_interval)
                         self.detect_and_update_all()
+                    else:
+                        # 不检测时暂停截图线程
+                        self.detector.pause_capture_thread()
                     last_detect_time = self.get_time()
 
                 self.update_phase_timer()
@@ -557,6 +618,8 @@ class Updater(QObject):
         except Exception as e:
             error(f"Exception in updater run: {e}")
             raise e
+        finally:
+            self.detector.close()
         info("Updater stopped.")
 
     def stop(self):